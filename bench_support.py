@@ -0,0 +1,79 @@
+"""Общие заготовки для нагрузочного прогона и проверки воркера рассылок.
+
+Схема базовых таблиц бота для пустой тестовой базы и заглушка Bot API,
+которая отвечает правдоподобными объектами вместо Telegram.
+"""
+import itertools
+import time
+
+from aiohttp import web
+
+STUB_TOKEN = "123456:LOADTEST"
+FIRST_USER_ID = 10 ** 12  # Не пересекается с настоящими пользователями
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        score INTEGER DEFAULT 0,
+        current_letter_index INTEGER DEFAULT 0,
+        learned_words TEXT[] DEFAULT '{}',
+        learning_progress JSONB DEFAULT '{}'::JSONB
+    );
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        user_id BIGINT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS words_table (
+        id SERIAL PRIMARY KEY,
+        word TEXT NOT NULL,
+        translation TEXT NOT NULL,
+        level INTEGER NOT NULL,
+        st_imp INTEGER DEFAULT 0,
+        image TEXT,
+        examples TEXT[],
+        romanization TEXT
+    );
+"""
+
+# Заглушка Bot API
+
+class StubBotApi:
+    """Отвечает на вызовы Bot API правдоподобными объектами и считает их"""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+
+    def message(self, chat_id, fields):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+        if "text" in fields:
+            message["text"] = fields["text"]
+        return message
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        fields = await request.post()
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method in ("sendMessage", "forwardMessage", "editMessageText"):
+            result = self.message(fields.get("chat_id", 0), fields)
+        elif method == "sendPhoto":
+            result = self.message(fields["chat_id"], fields)
+            file_id = f"stub-{hash(str(fields.get('photo'))) & 0xffffffff:x}"
+            result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int):
+        server = web.Application()
+        server.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(server, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
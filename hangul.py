@@ -0,0 +1,119 @@
+import unicodedata
+
+# Разбор слогов хангыля на буквы (чамо) по формуле Unicode:
+# слог = 0xAC00 + (начальная * 21 + гласная) * 28 + конечная
+
+SYLLABLE_BASE = 0xAC00
+SYLLABLE_LAST = 0xD7A3
+MEDIAL_COUNT = 21
+FINAL_COUNT = 28
+
+INITIALS = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+MEDIALS = "ㅏㅐㅑㅒㅓㅔㅕㅖㅗㅘㅙㅚㅛㅜㅝㅞㅟㅠㅡㅢㅣ"
+FINALS = ("", "ㄱ", "ㄲ", "ㄳ", "ㄴ", "ㄵ", "ㄶ", "ㄷ", "ㄹ", "ㄺ", "ㄻ", "ㄼ", "ㄽ", "ㄾ",
+          "ㄿ", "ㅀ", "ㅁ", "ㅂ", "ㅄ", "ㅅ", "ㅆ", "ㅇ", "ㅈ", "ㅊ", "ㅋ", "ㅌ", "ㅍ", "ㅎ")
+
+# Сдвоенные конечные согласные раскладываем на отдельные буквы алфавита
+COMPOUND_FINALS = {
+    "ㄳ": "ㄱㅅ", "ㄵ": "ㄴㅈ", "ㄶ": "ㄴㅎ", "ㄺ": "ㄹㄱ", "ㄻ": "ㄹㅁ", "ㄼ": "ㄹㅂ",
+    "ㄽ": "ㄹㅅ", "ㄾ": "ㄹㅌ", "ㄿ": "ㄹㅍ", "ㅀ": "ㄹㅎ", "ㅄ": "ㅂㅅ",
+}
+
+# Отдельные (несочетаемые) чамо из блока U+1100 приводим к совместимым U+3131
+CONJOINING_INITIALS = {chr(0x1100 + i): jamo for i, jamo in enumerate(INITIALS)}
+CONJOINING_MEDIALS = {chr(0x1161 + i): jamo for i, jamo in enumerate(MEDIALS)}
+CONJOINING_FINALS = {chr(0x11A7 + i): jamo for i, jamo in enumerate(FINALS) if jamo}
+CONJOINING = {**CONJOINING_INITIALS, **CONJOINING_MEDIALS, **CONJOINING_FINALS}
+
+
+def normalize(text: str) -> str:
+    # NFD-ввод с некоторых клавиатур собираем обратно в слоги
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def is_syllable(char: str) -> bool:
+    return SYLLABLE_BASE <= ord(char) <= SYLLABLE_LAST
+
+
+def decompose_char(char: str, split_compound: bool = False) -> str:
+    """Возвращает буквы слога; прочие символы возвращаются как есть"""
+    if is_syllable(char):
+        index = ord(char) - SYLLABLE_BASE
+        initial, rest = divmod(index, MEDIAL_COUNT * FINAL_COUNT)
+        medial, final = divmod(rest, FINAL_COUNT)
+        final_jamo = FINALS[final]
+        if split_compound:
+            final_jamo = COMPOUND_FINALS.get(final_jamo, final_jamo)
+        return INITIALS[initial] + MEDIALS[medial] + final_jamo
+    char = CONJOINING.get(char, char)
+    if split_compound:
+        return COMPOUND_FINALS.get(char, char)
+    return char
+
+
+def decompose(text: str, split_compound: bool = False) -> str:
+    """Раскладывает строку на последовательность букв хангыля"""
+    return "".join(decompose_char(char, split_compound) for char in normalize(text))
+
+
+def jamo_letters(text: str) -> list:
+    # Уникальные буквы в порядке появления, без пробелов и знаков препинания
+    seen = {}
+    for jamo in decompose(text, split_compound=True):
+        if not jamo.isspace():
+            seen.setdefault(jamo, None)
+    return list(seen)
+
+
+# Сравнение ответов
+
+EXACT = "exact"
+NEAR = "near"
+WRONG = "wrong"
+
+NEAR_MISS_RATE = 4  # Одна допустимая ошибка на каждые 4 буквы правильного ответа
+
+
+def answer_key(text: str) -> str:
+    """Форма для сравнения ответов: NFC, без пробелов, слоги разложены на буквы"""
+    return "".join(decompose(text, split_compound=True).split())
+
+
+def bounded_distance(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна, если оно не больше limit, иначе limit + 1.
+
+    Считается только полоса шириной 2 * limit + 1 вокруг диагонали, поэтому
+    время пропорционально длине строк, а не их произведению.
+    """
+    big = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return big
+    previous = [j if j <= limit else big for j in range(len(b) + 1)]
+    current = [big] * (len(b) + 1)
+    for i in range(1, len(a) + 1):
+        lo = max(1, i - limit)
+        hi = min(len(b), i + limit)
+        current[lo - 1] = i if lo == 1 and i <= limit else big
+        row_min = current[lo - 1]
+        for j in range(lo, hi + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost, big)
+            current[j] = value
+            row_min = min(row_min, value)
+        if hi < len(b):
+            current[hi + 1] = big  # Следующая строка читает эту клетку как соседнюю
+        if row_min > limit:
+            return big
+        previous, current = current, previous
+    return previous[len(b)]
+
+
+def grade_answer(answer: str, expected_key: str) -> str:
+    """EXACT, NEAR (почти верно) или WRONG; expected_key — заранее посчитанный answer_key"""
+    key = answer_key(answer)
+    if key == expected_key:
+        return EXACT
+    limit = len(expected_key) // NEAR_MISS_RATE
+    if key and limit and bounded_distance(key, expected_key, limit) <= limit:
+        return NEAR
+    return WRONG
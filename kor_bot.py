@@ -1,5 +1,7 @@
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler, ContextTypes
+from telegram.ext import BasePersistence, PersistenceInput, BaseUpdateProcessor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import gspread
@@ -9,114 +11,1461 @@ import asyncio
 import logging
 import json 
 import os
+import time
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta, timezone
+from functools import partial, wraps
+from types import MappingProxyType
 import asyncpg
+import hmac
+import socket
+from aiohttp import web
+from prometheus_client import Gauge, Histogram, start_http_server
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_exponential
+import hangul
 
 
 load_dotenv()
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+
+# Метрики Prometheus
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # По умолчанию endpoint выключен; 0 — не запускать
+
+BOT_API_POOL_SIZE = 256  # Как у ApplicationBuilder по умолчанию
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_LATENCY = Histogram(
+    "korbot_handler_seconds", "Время работы обработчика", ["handler", "status"], buckets=LATENCY_BUCKETS
+)
+DB_QUERY_LATENCY = Histogram(
+    "korbot_db_query_seconds", "Время выполнения запроса к БД", ["query"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_LATENCY = Histogram(
+    "korbot_telegram_request_seconds", "Время запроса к Bot API", ["method", "status"], buckets=LATENCY_BUCKETS
+)
+
+
+def instrumented(handler):
+    """Замеряет время обработчика в korbot_handler_seconds"""
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLER_LATENCY.labels(handler.__name__, status).observe(time.perf_counter() - started)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий каждый вызов Bot API"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_LATENCY.labels(api_method, status).observe(time.perf_counter() - started)
+
 # Инициализация базы данных
 
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # 0 — для pgbouncer
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+
+USER_CACHE_TTL = 300       # Секунд хранения строки пользователя в кэше
+USER_CACHE_SIZE = 50000    # Максимум пользователей в кэше
+
+# Все запросы бота по именам. Текст запроса постоянный, поэтому asyncpg
+# один раз готовит его на каждом соединении и дальше берёт из кэша выражений.
+QUERIES = {
+    "ensure_user": """
+        INSERT INTO users (user_id) VALUES ($1)
+        ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+        RETURNING *
+    """,
+    "update_progress": """
+        UPDATE users 
+        SET score = score + $1, current_letter_index = $2 
+        WHERE user_id = $3
+    """,
+    "get_learning_progress": """
+        SELECT COALESCE(learning_progress, '{}'::JSONB) AS learning_progress
+        FROM users WHERE user_id = $1
+    """,
+    "get_all_words": "SELECT * FROM words_table ORDER BY level, st_imp DESC, id",
+    "get_due_reviews": """
+        SELECT wt.*, ulw.ease, ulw.interval_days, ulw.repetitions
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND ulw.due_at <= now()
+        ORDER BY ulw.due_at
+        LIMIT $2
+    """,
+    "save_review": """
+        UPDATE user_learned_words
+        SET ease = $3, interval_days = $4, repetitions = $5, due_at = $6
+        WHERE user_id = $1 AND word_id = $2
+    """,
+    "count_learned_words_by_level": """
+        SELECT COUNT(*)
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND wt.level = $2
+    """,
+    "get_dictionary_page": """
+        SELECT wt.word, wt.translation, ulw.learned_at, ulw.word_id
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND wt.level = $2
+        ORDER BY ulw.learned_at DESC, ulw.word_id DESC
+        LIMIT $3
+    """,
+    "get_dictionary_page_older": """
+        SELECT wt.word, wt.translation, ulw.learned_at, ulw.word_id
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND wt.level = $2 AND (ulw.learned_at, ulw.word_id) < ($3, $4)
+        ORDER BY ulw.learned_at DESC, ulw.word_id DESC
+        LIMIT $5
+    """,
+    "get_dictionary_page_newer": """
+        SELECT wt.word, wt.translation, ulw.learned_at, ulw.word_id
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND wt.level = $2 AND (ulw.learned_at, ulw.word_id) > ($3, $4)
+        ORDER BY ulw.learned_at, ulw.word_id
+        LIMIT $5
+    """,
+    "get_learned_word_ids": "SELECT word_id FROM user_learned_words WHERE user_id = $1",
+    "get_game_word_ids": """
+        SELECT ulw.word_id
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1 AND ($2::INTEGER IS NULL OR wt.level = $2)
+        ORDER BY random()
+    """,
+    "get_learned_levels": """
+        SELECT DISTINCT wt.level
+        FROM user_learned_words ulw
+        JOIN words_table wt ON wt.id = ulw.word_id
+        WHERE ulw.user_id = $1
+        ORDER BY wt.level
+    """,
+    "clear_learned_words": "DELETE FROM user_learned_words WHERE user_id = $1",
+    "create_user": "INSERT INTO users (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
+    "create_users": "INSERT INTO users (user_id) SELECT unnest($1::BIGINT[]) ON CONFLICT (user_id) DO NOTHING",
+    "add_subscriber": "INSERT INTO subscriptions (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
+    "delete_subscriber": "DELETE FROM subscriptions WHERE user_id = $1",
+    "delete_subscribers": "DELETE FROM subscriptions WHERE user_id = ANY($1::BIGINT[])",
+    "get_subscribers": "SELECT user_id FROM subscriptions",
+    "create_broadcast_job": """
+        INSERT INTO broadcast_jobs (source_chat, message_id) VALUES ($1, $2)
+        ON CONFLICT (source_chat, message_id) DO NOTHING
+        RETURNING id
+    """,
+    "add_broadcast_recipients": """
+        WITH inserted AS (
+            INSERT INTO broadcast_recipients (job_id, user_id, batch_no)
+            SELECT $1, user_id, (row_number() OVER (ORDER BY user_id) - 1) / $2
+            FROM subscriptions
+            RETURNING batch_no
+        ), batches AS (
+            INSERT INTO broadcast_batches (job_id, batch_no, size)
+            SELECT $1, batch_no, COUNT(*) FROM inserted GROUP BY batch_no
+        )
+        UPDATE broadcast_jobs SET total = (SELECT COUNT(*) FROM inserted) WHERE id = $1
+    """,
+    "claim_broadcast_batch": """
+        WITH claimed AS (
+            UPDATE broadcast_batches b
+            SET claimed_by = $1, claimed_until = now() + $2 * INTERVAL '1 second', attempts = b.attempts + 1
+            WHERE (b.job_id, b.batch_no) = (
+                SELECT job_id, batch_no FROM broadcast_batches
+                WHERE finished_at IS NULL AND (claimed_until IS NULL OR claimed_until < now())
+                ORDER BY job_id, batch_no
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING b.job_id, b.batch_no
+        )
+        SELECT c.job_id, c.batch_no, j.source_chat, j.message_id
+        FROM claimed c JOIN broadcast_jobs j ON j.id = c.job_id
+    """,
+    "get_batch_recipients": """
+        SELECT user_id FROM broadcast_recipients
+        WHERE job_id = $1 AND batch_no = $2 AND status = 'pending'
+    """,
+    "checkpoint_broadcast": """
+        WITH updated AS (
+            UPDATE broadcast_recipients r SET status = d.status, updated_at = now()
+            FROM unnest($2::BIGINT[], $3::TEXT[]) AS d(user_id, status)
+            WHERE r.job_id = $1 AND r.user_id = d.user_id AND r.status = 'pending'
+            RETURNING r.status
+        )
+        UPDATE broadcast_jobs SET
+            sent = sent + (SELECT COUNT(*) FROM updated WHERE status = 'sent'),
+            dead = dead + (SELECT COUNT(*) FROM updated WHERE status = 'dead'),
+            failed = failed + (SELECT COUNT(*) FROM updated WHERE status = 'failed'),
+            updated_at = now()
+        WHERE id = $1
+    """,
+    "extend_broadcast_lease": """
+        UPDATE broadcast_batches SET claimed_until = now() + $4 * INTERVAL '1 second'
+        WHERE job_id = $1 AND batch_no = $2 AND claimed_by = $3
+    """,
+    "release_broadcast_batch": """
+        UPDATE broadcast_batches SET claimed_until = NULL
+        WHERE job_id = $1 AND batch_no = $2 AND claimed_by = $3 AND finished_at IS NULL
+    """,
+    "lock_broadcast_job": "SELECT id FROM broadcast_jobs WHERE id = $1 FOR UPDATE",
+    "finish_broadcast_batch": """
+        UPDATE broadcast_batches SET finished_at = now()
+        WHERE job_id = $1 AND batch_no = $2 AND claimed_by = $3
+    """,
+    "finish_broadcast_job": """
+        UPDATE broadcast_jobs SET finished_at = now(), updated_at = now()
+        WHERE id = $1 AND finished_at IS NULL
+          AND NOT EXISTS (SELECT 1 FROM broadcast_batches WHERE job_id = $1 AND finished_at IS NULL)
+    """,
+    "get_broadcast_jobs": """
+        SELECT j.id, j.source_chat, j.message_id, j.total, j.sent, j.dead, j.failed,
+               j.total - j.sent - j.dead - j.failed AS pending,
+               (SELECT COUNT(*) FROM broadcast_batches b WHERE b.job_id = j.id AND b.finished_at IS NULL) AS batches_left,
+               (SELECT COUNT(DISTINCT b.claimed_by) FROM broadcast_batches b WHERE b.job_id = j.id) AS workers,
+               j.created_at, j.updated_at, j.finished_at,
+               (j.sent + j.dead + j.failed) / NULLIF(EXTRACT(EPOCH FROM j.updated_at - j.created_at), 0) AS per_second
+        FROM broadcast_jobs j
+        ORDER BY j.id DESC
+        LIMIT $1
+    """,
+    "get_file_ids": "SELECT url, file_id FROM telegram_file_ids",
+    "save_file_id": """
+        INSERT INTO telegram_file_ids (url, file_id) VALUES ($1, $2)
+        ON CONFLICT (url) DO UPDATE SET file_id = EXCLUDED.file_id, updated_at = now()
+    """,
+    "delete_file_ids": "DELETE FROM telegram_file_ids WHERE url = ANY($1::TEXT[])",
+    "get_user_states": "SELECT user_id, user_data, progress FROM bot_user_state",
+    "save_user_state": """
+        INSERT INTO bot_user_state (user_id, user_data, progress)
+        VALUES ($1, $2::JSONB, $3::JSONB)
+        ON CONFLICT (user_id) DO UPDATE
+        SET user_data = EXCLUDED.user_data, progress = EXCLUDED.progress, updated_at = now()
+    """,
+    "delete_user_state": "DELETE FROM bot_user_state WHERE user_id = $1",
+    "add_scores": """
+        UPDATE users u SET score = COALESCE(u.score, 0) + d.delta
+        FROM unnest($1::BIGINT[], $2::INTEGER[]) AS d(user_id, delta)
+        WHERE u.user_id = d.user_id
+    """,
+    "merge_learning_progress": """
+        UPDATE users u
+        SET learning_progress = COALESCE(u.learning_progress, '{}'::JSONB) || d.progress
+        FROM unnest($1::BIGINT[], $2::JSONB[]) AS d(user_id, progress)
+        WHERE u.user_id = d.user_id
+    """,
+    "add_learned_words": """
+        INSERT INTO user_learned_words (user_id, word_id, learned_at)
+        SELECT * FROM unnest($1::BIGINT[], $2::INTEGER[], $3::TIMESTAMPTZ[])
+        ON CONFLICT (user_id, word_id) DO NOTHING
+    """,
+}
+
+
 class Database:
     def __init__(self):
         self.pool = None
+        self.user_cache = {}   # user_id -> (время истечения, строка users как dict)
+        self.query_stats = {}  # имя запроса -> [количество, суммарное время, максимум]
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(os.getenv("DB_URL"))
+        self.pool = await asyncpg.create_pool(
+            os.getenv("DB_URL"),
+            max_size=DB_POOL_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE
+        )
 
-    async def get_user(self, user_id: int):
-        return await self.pool.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+    # Выполнение именованных запросов с замером времени
 
-    async def create_user(self, user_id: int):
-        await self.pool.execute("""
-            INSERT INTO users (user_id) VALUES ($1) 
-            ON CONFLICT (user_id) DO NOTHING
-        """, user_id)
+    async def run(self, method: str, name: str, *args, conn=None):
+        started = time.perf_counter()
+        try:
+            return await getattr(conn or self.pool, method)(QUERIES[name], *args)
+        finally:
+            self.record_query(name, time.perf_counter() - started)
+
+    def record_query(self, name: str, elapsed: float):
+        DB_QUERY_LATENCY.labels(name).observe(elapsed)
+        stats = self.query_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            logging.warning(f"Медленный запрос {name}: {elapsed * 1000:.1f} мс")
+
+    async def fetch(self, name: str, *args, conn=None):
+        return await self.run("fetch", name, *args, conn=conn)
+
+    async def fetchrow(self, name: str, *args, conn=None):
+        return await self.run("fetchrow", name, *args, conn=conn)
+
+    async def fetchval(self, name: str, *args, conn=None):
+        return await self.run("fetchval", name, *args, conn=conn)
+
+    async def execute(self, name: str, *args, conn=None):
+        return await self.run("execute", name, *args, conn=conn)
+
+    async def executemany(self, name: str, args: list, conn=None):
+        return await self.run("executemany", name, args, conn=conn)
+
+    def query_report(self):
+        # Самые затратные запросы сверху
+        return sorted(
+            ((name, count, total, total / count, peak) for name, (count, total, peak) in self.query_stats.items()),
+            key=lambda row: row[2],
+            reverse=True
+        )
 
-    async def update_progress(self, user_id: int, score: int, current_letter_index: int):
-        await self.pool.execute("""
-            UPDATE users 
-            SET score = score + $1, current_letter_index = $2 
-            WHERE user_id = $3
-        """, score, current_letter_index, user_id)
+    # Пользователи
+
+    def cache_user(self, user_id: int, row: dict):
+        self.user_cache.pop(user_id, None)
+        self.user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, row)
+        if len(self.user_cache) > USER_CACHE_SIZE:
+            # Вытесняем самую давнюю запись
+            self.user_cache.pop(next(iter(self.user_cache)))
+
+    def cached_user(self, user_id: int):
+        entry = self.user_cache.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    async def ensure_user(self, user_id: int) -> dict:
+        """Возвращает строку пользователя, создавая её при необходимости"""
+        row = self.cached_user(user_id)
+        if row is not None:
+            return row
+        # Один запрос: DO UPDATE возвращает строку и для существующего пользователя, в том числе при гонке вставок
+        row = dict(await self.fetchrow("ensure_user", user_id))
+        self.cache_user(user_id, row)
+        return row
+
+    def adjust_cached_score(self, user_id: int, delta: int):
+        row = self.cached_user(user_id)
+        if row is not None:
+            row['score'] = (row.get('score') or 0) + delta
 
-    async def add_learned_word(self, user_id: int, word: str, translation: str, level: int, image_url: str = None):
+    async def update_progress(self, user_id: int, score: int, current_letter_index: int):
+        await self.execute("update_progress", score, current_letter_index, user_id)
+        # Обновляем кэш вместо повторного чтения
+        row = self.cached_user(user_id)
+        if row is not None:
+            row['score'] = (row.get('score') or 0) + score
+            row['current_letter_index'] = current_letter_index
+
+    async def get_learning_progress(self, user_id: int) -> dict:
+        progress = await self.fetchval("get_learning_progress", user_id)
+        if progress is None:
+            return {}
+        if isinstance(progress, str):  # asyncpg отдаёт JSONB строкой
+            try:
+                return json.loads(progress)
+            except ValueError:
+                return {}
+        return progress
+
+    # Слова
+
+    async def get_all_words(self):
+        return await self.fetch("get_all_words")
+
+    async def ensure_learned_words_schema(self):
+        # Изученные слова хранятся отдельной таблицей вместо массива users.learned_words
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                exists = await conn.fetchval("SELECT to_regclass('user_learned_words') IS NOT NULL")
+                if exists:
+                    return
+
+                await conn.execute("""
+                    CREATE TABLE user_learned_words (
+                        user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                        word_id INTEGER NOT NULL REFERENCES words_table(id) ON DELETE CASCADE,
+                        learned_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (user_id, word_id)
+                    );
+                    CREATE INDEX user_learned_words_learned_at_idx
+                        ON user_learned_words (user_id, learned_at);
+                    CREATE INDEX user_learned_words_word_idx
+                        ON user_learned_words (word_id);
+                """)
+
+                # Однократный перенос из массивов; порядок в массиве сохраняем через learned_at
+                migrated = await conn.execute("""
+                    INSERT INTO user_learned_words (user_id, word_id, learned_at)
+                    SELECT u.user_id, wt.id,
+                           now() - (cardinality(u.learned_words) - min(lw.pos)) * INTERVAL '1 millisecond'
+                    FROM users u
+                    CROSS JOIN LATERAL unnest(u.learned_words) WITH ORDINALITY AS lw(word_id, pos)
+                    JOIN words_table wt ON wt.id::TEXT = lw.word_id
+                    GROUP BY u.user_id, u.learned_words, wt.id
+                    ON CONFLICT (user_id, word_id) DO NOTHING
+                """)
+                logging.info(f"Перенос изученных слов: {migrated}")
+
+    async def ensure_review_schema(self):
+        # Параметры интервального повторения (SM-2) для каждого изученного слова
         await self.pool.execute("""
-            INSERT INTO learned_words (user_id, word, translation, level, image_url)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (user_id, word) DO NOTHING
-        """, user_id, word, translation, level, image_url)
-
-    async def get_learned_words(self, user_id: int, level: int = None):
-        query = "SELECT * FROM learned_words WHERE user_id = $1"
-        params = [user_id]
-        if level is not None:
-            query += " AND level = $2"
-            params.append(level)
-        return await self.pool.fetch(query, *params)
+            ALTER TABLE user_learned_words
+                ADD COLUMN IF NOT EXISTS due_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                ADD COLUMN IF NOT EXISTS ease REAL NOT NULL DEFAULT 2.5,
+                ADD COLUMN IF NOT EXISTS interval_days REAL NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS repetitions INTEGER NOT NULL DEFAULT 0;
+            CREATE INDEX IF NOT EXISTS user_learned_words_due_idx
+                ON user_learned_words (user_id, due_at);
+        """)
+
+    async def get_due_reviews(self, user_id: int, limit: int):
+        # Чтение диапазона индекса (user_id, due_at) до now(): только слова, которым пора, сначала самые просроченные
+        return await self.fetch("get_due_reviews", user_id, limit)
+
+    async def save_review(self, user_id: int, word_id: int, ease: float, interval_days: float,
+                          repetitions: int, due_at: datetime):
+        await self.execute("save_review", user_id, word_id, ease, interval_days, repetitions, due_at)
+
+    async def count_learned_words(self, user_id: int, level: int) -> int:
+        return await self.fetchval("count_learned_words_by_level", user_id, level)
+
+    async def get_dictionary_page(self, user_id: int, level: int, limit: int,
+                                  direction: str = None, learned_at: datetime = None, word_id: int = None):
+        """Страница словаря от новых к старым; direction — "older" или "newer" от курсора"""
+        if direction == "older":
+            return await self.fetch("get_dictionary_page_older", user_id, level, learned_at, word_id, limit)
+        if direction == "newer":
+            rows = await self.fetch("get_dictionary_page_newer", user_id, level, learned_at, word_id, limit)
+            return rows[::-1]
+        return await self.fetch("get_dictionary_page", user_id, level, limit)
+
+    async def get_learned_word_ids(self, user_id: int) -> set:
+        rows = await self.fetch("get_learned_word_ids", user_id)
+        return {row['word_id'] for row in rows}
+
+    async def get_game_word_ids(self, user_id: int, level: int = None) -> list:
+        """Изученные слова уровня (или все) в случайном порядке — только id"""
+        rows = await self.fetch("get_game_word_ids", user_id, level)
+        return [row['word_id'] for row in rows]
+
+    async def get_learned_levels(self, user_id: int):
+        return await self.fetch("get_learned_levels", user_id)
+
+    async def clear_learned_words(self, user_id: int):
+        await self.execute("clear_learned_words", user_id)
+
+    # Подписки
 
     async def delete_subscriber(self, user_id: int):
-        await self.pool.execute("DELETE FROM subscriptions WHERE user_id = $1", user_id)
+        await self.execute("delete_subscriber", user_id)
 
     async def add_subscriber(self, user_id: int):
         try:
             # Добавляем пользователя в таблицу users (если его ещё нет)
-            await self.pool.execute("""
-                INSERT INTO users (user_id) 
-                VALUES ($1) 
-                ON CONFLICT (user_id) DO NOTHING
-            """, user_id)
+            await self.execute("create_user", user_id)
 
             # Добавляем пользователя в таблицу subscriptions
-            await self.pool.execute("""
-                INSERT INTO subscriptions (user_id) 
-                VALUES ($1) 
-                ON CONFLICT (user_id) DO NOTHING
-            """, user_id)
+            await self.execute("add_subscriber", user_id)
         except Exception as e:
             logging.error(f"Ошибка при добавлении подписчика: {e}")
 
+    async def delete_subscribers(self, user_ids: list):
+        # Одним запросом удаляем всех, кто заблокировал бота
+        if not user_ids:
+            return
+        await self.execute("delete_subscribers", list(user_ids))
+
     async def get_subscribers(self):
-        return await self.pool.fetch("SELECT user_id FROM subscriptions")
+        return await self.fetch("get_subscribers")
+
+    # Задания рассылки
+
+    async def ensure_broadcast_schema(self):
+        # Получатели фиксируются при создании задания, статус каждого пишется пачками
+        await self.pool.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                source_chat TEXT NOT NULL,
+                message_id BIGINT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                finished_at TIMESTAMPTZ,
+                UNIQUE (source_chat, message_id)
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                batch_no INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'pending',
+                updated_at TIMESTAMPTZ,
+                PRIMARY KEY (job_id, user_id)
+            );
+            ALTER TABLE broadcast_recipients ADD COLUMN IF NOT EXISTS batch_no INTEGER NOT NULL DEFAULT 0;
+            DROP INDEX IF EXISTS broadcast_recipients_pending_idx;
+            CREATE INDEX IF NOT EXISTS broadcast_recipients_batch_idx
+                ON broadcast_recipients (job_id, batch_no) WHERE status = 'pending';
+
+            -- Очередь пачек: воркеры забирают их через FOR UPDATE SKIP LOCKED и держат по аренде
+            CREATE TABLE IF NOT EXISTS broadcast_batches (
+                job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                batch_no INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                claimed_by TEXT,
+                claimed_until TIMESTAMPTZ,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                finished_at TIMESTAMPTZ,
+                PRIMARY KEY (job_id, batch_no)
+            );
+            CREATE INDEX IF NOT EXISTS broadcast_batches_open_idx
+                ON broadcast_batches (job_id, batch_no) WHERE finished_at IS NULL;
+
+            -- Незавершённые задания без пачек (созданные до разбиения) выполняются одной пачкой
+            INSERT INTO broadcast_batches (job_id, batch_no, size)
+            SELECT j.id, 0, j.total FROM broadcast_jobs j
+            WHERE j.finished_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM broadcast_batches b WHERE b.job_id = j.id);
+        """)
+
+    async def create_broadcast_job(self, source_chat: str, message_id: int, batch_size: int):
+        """Создаёт задание со снимком подписчиков, разбитым на пачки; None, если оно уже было"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                job_id = await self.fetchval("create_broadcast_job", source_chat, message_id, conn=conn)
+                if job_id is not None:
+                    await self.execute("add_broadcast_recipients", job_id, batch_size, conn=conn)
+                    await self.execute("finish_broadcast_job", job_id, conn=conn)  # Подписчиков может не быть
+                return job_id
+
+    async def claim_broadcast_batch(self, worker_id: str, lease: float):
+        # Занятые другими воркерами пачки пропускаются, а не ожидаются
+        return await self.fetchrow("claim_broadcast_batch", worker_id, lease)
+
+    async def get_batch_recipients(self, job_id: int, batch_no: int) -> list:
+        rows = await self.fetch("get_batch_recipients", job_id, batch_no)
+        return [row['user_id'] for row in rows]
+
+    async def checkpoint_broadcast(self, job_id: int, batch_no: int, worker_id: str, results: list, lease: float):
+        # results: [(user_id, "sent" | "dead" | "failed"), ...]
+        user_ids, statuses = zip(*results)
+        dead_users = [user_id for user_id, status in results if status == "dead"]
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self.execute("checkpoint_broadcast", job_id, list(user_ids), list(statuses), conn=conn)
+                # Заблокировавших бота удаляем вместе с контрольной точкой
+                if dead_users:
+                    await self.execute("delete_subscribers", dead_users, conn=conn)
+                await self.execute("extend_broadcast_lease", job_id, batch_no, worker_id, lease, conn=conn)
+
+    async def release_broadcast_batch(self, job_id: int, batch_no: int, worker_id: str):
+        await self.execute("release_broadcast_batch", job_id, batch_no, worker_id)
+
+    async def finish_broadcast_batch(self, job_id: int, batch_no: int, worker_id: str):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Блокировка задания: последнюю пачку видит завершённой ровно один воркер
+                await self.fetchval("lock_broadcast_job", job_id, conn=conn)
+                await self.execute("finish_broadcast_batch", job_id, batch_no, worker_id, conn=conn)
+                await self.execute("finish_broadcast_job", job_id, conn=conn)
+
+    async def get_broadcast_jobs(self, limit: int = 20):
+        """Последние задания с прогрессом и скоростью (получателей в секунду)"""
+        return await self.fetch("get_broadcast_jobs", limit)
+
+    # Кэш file_id картинок
+
+    async def ensure_file_ids_schema(self):
+        await self.pool.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_file_ids (
+                url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+
+    async def get_file_ids(self) -> dict:
+        rows = await self.fetch("get_file_ids")
+        return {row['url']: row['file_id'] for row in rows}
+
+    async def save_file_id(self, url: str, file_id: str):
+        await self.execute("save_file_id", url, file_id)
+
+    async def delete_file_ids(self, urls: list):
+        await self.execute("delete_file_ids", list(urls))
+
+    # Состояние диалогов
+
+    async def ensure_user_state_schema(self):
+        await self.pool.execute("""
+            CREATE TABLE IF NOT EXISTS bot_user_state (
+                user_id BIGINT PRIMARY KEY,
+                user_data JSONB NOT NULL DEFAULT '{}'::JSONB,
+                progress JSONB,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+
+    async def get_user_states(self):
+        return await self.fetch("get_user_states")
+
+    async def save_user_states(self, rows: list):
+        # rows: [(user_id, user_data_json, progress_json), ...]
+        await self.executemany("save_user_state", rows)
+
+    async def delete_user_state(self, user_id: int):
+        await self.execute("delete_user_state", user_id)
+
+    async def apply_progress_batch(self, users: list, score_deltas: list, progress: list, learned: list):
+        # Один пакет накопленных изменений за одну транзакцию
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self.execute("create_users", users, conn=conn)
+                if score_deltas:
+                    user_ids, deltas = zip(*score_deltas)
+                    await self.execute("add_scores", list(user_ids), list(deltas), conn=conn)
+                if progress:
+                    user_ids, values = zip(*progress)
+                    await self.execute("merge_learning_progress", list(user_ids), list(values), conn=conn)
+                if learned:
+                    user_ids, word_ids, learned_at = zip(*learned)
+                    await self.execute(
+                        "add_learned_words", list(user_ids), list(word_ids), list(learned_at), conn=conn
+                    )
+
+    async def ensure_words_notify(self):
+        # Триггер уведомляет кэш слов об изменениях words_table
+        await self.pool.execute("""
+            CREATE OR REPLACE FUNCTION notify_words_table_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('words_table_changed', TG_OP);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS words_table_changed ON words_table;
+            CREATE TRIGGER words_table_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON words_table
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_words_table_changed();
+        """)
+
     async def close(self):
+        for name, count, total, mean, peak in self.query_report():
+            logging.info(
+                f"Запрос {name}: {count} раз, всего {total * 1000:.0f} мс, "
+                f"среднее {mean * 1000:.2f} мс, максимум {peak * 1000:.1f} мс"
+            )
         if self.pool:
             await self.pool.close()
 db = Database()
 
 
+# Кэш словаря words_table
+
+WORDS_CHANNEL = "words_table_changed"
+LISTEN_CHECK_INTERVAL = 30  # Секунд между проверками соединения LISTEN
+HARD_DISTRACTOR_SHARE = 0.5  # Доля неверных вариантов похожей длины
+
+
+class WordCatalog:
+    """Общий кэш words_table в памяти, индексированный по уровню и id"""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_level = {}       # level -> кортеж слов, отсортированных по st_imp DESC
+        self.level_groups = {}   # level -> список групп слов с одинаковым st_imp
+        self.translations = {}   # level -> кортеж уникальных переводов
+        self.by_length = {}      # level -> {длина перевода: кортеж переводов}
+        self.answer_keys = {}    # id -> слово, разложенное на буквы для проверки ответов
+        self.listener_conn = None
+        self.listen_task = None
+        self.watch_task = None
+        self.reload_task = None
+        self.dirty = False  # Пришло уведомление, которое ещё не учтено загрузкой
+
+    async def load(self):
+        rows = await db.get_all_words()
+
+        by_id = {}
+        by_level = {}
+        level_groups = {}
+        answer_keys = {}
+        for row in rows:
+            by_id[row['id']] = row
+            answer_keys[row['id']] = hangul.answer_key(row['word'] or "")
+            by_level.setdefault(row['level'], []).append(row)
+            groups = level_groups.setdefault(row['level'], [])
+            if groups and groups[-1][0]['st_imp'] == row['st_imp']:
+                groups[-1].append(row)
+            else:
+                groups.append([row])
+
+        # Подменяем индексы целиком, чтобы обработчики не видели частично загруженные данные
+        self.by_id = by_id
+        self.answer_keys = answer_keys
+        self.by_level = {level: tuple(words) for level, words in by_level.items()}
+        self.level_groups = {level: [tuple(g) for g in groups] for level, groups in level_groups.items()}
+        self.build_distractors()
+        logging.info(f"Загружено слов в кэш: {len(by_id)}")
+
+    def build_distractors(self):
+        translations = {}
+        by_length = {}
+        for level, words in self.by_level.items():
+            unique = tuple(dict.fromkeys(w['translation'] for w in words if w['translation']))
+            translations[level] = unique
+            buckets = {}
+            for translation in unique:
+                buckets.setdefault(len(translation), []).append(translation)
+            by_length[level] = {length: tuple(items) for length, items in buckets.items()}
+        self.translations, self.by_length = translations, by_length
+
+    def distractors(self, word, k: int = 2):
+        """k разных неверных переводов того же уровня"""
+        correct = word['translation']
+        pool = self.translations.get(word['level'], ())
+        if len(pool) <= k + 1:
+            return [t for t in pool if t != correct][:k]
+
+        # Часть вариантов берём похожей длины — их сложнее отбросить
+        chosen = []
+        buckets = self.by_length.get(word['level'], {})
+        nearby = [b for b in (buckets.get(len(correct) + delta) for delta in (0, -1, 1)) if b]
+        total = sum(len(b) for b in nearby)
+        hard = round(k * HARD_DISTRACTOR_SHARE)
+        for _ in range(hard * 4):  # Ограничиваем попытки для маленьких групп
+            if len(chosen) >= hard or total < 2:
+                break
+            index = random.randrange(total)
+            for bucket in nearby:
+                if index < len(bucket):
+                    candidate = bucket[index]
+                    break
+                index -= len(bucket)
+            if candidate != correct and candidate not in chosen:
+                chosen.append(candidate)
+
+        # Остальные — случайной выборкой по индексу без перемешивания всего списка
+        while len(chosen) < k:
+            candidate = pool[random.randrange(len(pool))]
+            if candidate != correct and candidate not in chosen:
+                chosen.append(candidate)
+        return chosen
+
+    def get(self, word_id):
+        return self.by_id.get(int(word_id))
+
+    def grade(self, word_id, word: str, answer: str) -> str:
+        # Разложение слов каталога посчитано при загрузке; слово не из кэша раскладываем сейчас
+        key = self.answer_keys.get(word_id)
+        if key is None:
+            key = hangul.answer_key(word)
+        return hangul.grade_answer(answer, key)
+
+    def shuffled_level(self, level: int):
+        # Порядок как у ORDER BY st_imp DESC, random(), но без запроса к БД
+        result = []
+        for group in self.level_groups.get(level, []):
+            group = list(group)
+            random.shuffle(group)
+            result.extend(group)
+        return result
+
+    def start(self):
+        # Ссылку на задачу храним, чтобы её не собрал сборщик мусора
+        self.listen_task = asyncio.create_task(
+            startup_phase("LISTEN изменений слов", self.listen(), required=False)
+        )
+
+    async def listen(self):
+        # Отдельное соединение: LISTEN должен жить всё время работы бота
+        await db.ensure_words_notify()
+        self.watch_task = asyncio.create_task(self.watch_listener())
+        await self.connect_listener()
+
+    async def connect_listener(self):
+        self.listener_conn = await asyncpg.connect(os.getenv("DB_URL"))
+        await self.listener_conn.add_listener(WORDS_CHANNEL, self.on_notify)
+
+    async def watch_listener(self):
+        # Разорванное соединение молча прекращает уведомления, поэтому проверяем его сами
+        while True:
+            await asyncio.sleep(LISTEN_CHECK_INTERVAL)
+            try:
+                if self.listener_conn is None or self.listener_conn.is_closed():
+                    raise ConnectionError("соединение закрыто")
+                await self.listener_conn.fetchval("SELECT 1", timeout=5)
+            except Exception as e:
+                logging.warning(f"Переподключение LISTEN {WORDS_CHANNEL}: {e}")
+                await self.reconnect_listener()
+
+    async def reconnect_listener(self):
+        if self.listener_conn is not None:
+            self.listener_conn.terminate()
+            self.listener_conn = None
+        try:
+            await self.connect_listener()
+        except Exception as e:
+            logging.error(f"Не удалось переподключить LISTEN: {e}")
+            return
+        # Изменения за время разрыва могли пройти без уведомлений
+        self.on_notify(None, None, WORDS_CHANNEL, "reconnect")
+
+    def on_notify(self, connection, pid, channel, payload):
+        # Пачку изменений (например, импорт) перечитываем один раз; уведомление,
+        # пришедшее во время загрузки, вызовет ещё одну загрузку после неё
+        self.dirty = True
+        if self.reload_task and not self.reload_task.done():
+            return
+        self.reload_task = asyncio.create_task(self.reload_later())
+
+    async def reload_later(self, delay: float = 1.0):
+        while self.dirty:
+            await asyncio.sleep(delay)
+            self.dirty = False
+            try:
+                await self.load()
+                await file_ids.prune()
+            except Exception as e:
+                logging.error(f"Ошибка обновления кэша слов: {e}")
+
+    async def close(self):
+        for task in (self.listen_task, self.watch_task):
+            if task:
+                task.cancel()
+        if self.listener_conn:
+            await self.listener_conn.close()
+
+
+catalog = WordCatalog()
+
+
+# Отложенная запись прогресса обучения
+
+PROGRESS_FLUSH_INTERVAL = 2  # Секунд между пакетными записями прогресса
+
+
+class ProgressBuffer:
+    """Копит очки, позиции learning_progress и изученные слова в памяти.
+
+    Изменения пишутся пакетом раз в PROGRESS_FLUSH_INTERVAL секунд и при
+    остановке. Перед чтением словаря пользователя его изменения сбрасываются
+    через flush(user_id).
+    """
+
+    def __init__(self):
+        self.score_deltas = {}  # user_id -> изменение счёта
+        self.progress = {}      # user_id -> {level: {"index": n}}
+        self.learned = {}       # user_id -> {word_id: learned_at}
+        self.flush_task = None
+        self.flush_lock = None  # Создаётся в start(), в работающем цикле
+
+    async def get_score(self, user_id: int):
+        # Строка в кэше уже учитывает незаписанные изменения счёта
+        if db.cached_user(user_id) is None:
+            await self.flush(user_id)
+        user = await db.ensure_user(user_id)
+        return user.get('score') or 0
+
+    def add_score(self, user_id: int, delta: int):
+        self.score_deltas[user_id] = self.score_deltas.get(user_id, 0) + delta
+        db.adjust_cached_score(user_id, delta)
+
+    def set_position(self, user_id: int, level: int, index: int):
+        self.progress.setdefault(user_id, {})[str(level)] = {"index": index}
+
+    def add_learned_word(self, user_id: int, word_id: int):
+        self.learned.setdefault(user_id, {}).setdefault(word_id, datetime.now(timezone.utc))
+
+    def pending_word_ids(self, user_id: int):
+        return set(self.learned.get(user_id, ()))
+
+    def discard_learned_words(self, user_id: int):
+        self.learned.pop(user_id, None)
+
+    def take(self, user_id: int = None):
+        if user_id is None:
+            batch = (self.score_deltas, self.progress, self.learned)
+            self.score_deltas, self.progress, self.learned = {}, {}, {}
+            return batch
+        return (
+            {user_id: self.score_deltas.pop(user_id)} if user_id in self.score_deltas else {},
+            {user_id: self.progress.pop(user_id)} if user_id in self.progress else {},
+            {user_id: self.learned.pop(user_id)} if user_id in self.learned else {},
+        )
+
+    def restore(self, score_deltas, progress, learned):
+        # После ошибки возвращаем изменения, не затирая более новые
+        for user_id, delta in score_deltas.items():
+            self.score_deltas[user_id] = self.score_deltas.get(user_id, 0) + delta
+        for user_id, levels in progress.items():
+            self.progress[user_id] = {**levels, **self.progress.get(user_id, {})}
+        for user_id, words in learned.items():
+            self.learned[user_id] = {**words, **self.learned.get(user_id, {})}
+
+    async def flush(self, user_id: int = None):
+        async with self.flush_lock:
+            score_deltas, progress, learned = self.take(user_id)
+            if not (score_deltas or progress or learned):
+                return
+            try:
+                await db.apply_progress_batch(
+                    list(set(score_deltas) | set(progress) | set(learned)),
+                    [(uid, delta) for uid, delta in score_deltas.items() if delta],
+                    [(uid, json.dumps(levels)) for uid, levels in progress.items()],
+                    [(uid, word_id, at) for uid, words in learned.items() for word_id, at in words.items()]
+                )
+            except BaseException as e:
+                # Возвращаем изменения и при отмене посреди записи (остановка бота)
+                if not isinstance(e, asyncio.CancelledError):
+                    logging.error(f"Ошибка сохранения прогресса: {e}")
+                self.restore(score_deltas, progress, learned)
+                if not isinstance(e, Exception):
+                    raise
+
+    async def flush_forever(self):
+        while True:
+            await asyncio.sleep(PROGRESS_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = asyncio.create_task(self.flush_forever())
+
+    async def stop(self):
+        # До start() обработчики не работали и записывать нечего
+        if not self.flush_task:
+            return
+        # Ждём отмены фоновой записи, чтобы прерванная пачка вернулась в буфер
+        self.flush_task.cancel()
+        await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+
+
+progress_buffer = ProgressBuffer()
+
+
+# Кэш file_id картинок: Telegram не скачивает изображение повторно
+
+class FileIdCache:
+    """Соответствие URL картинки и file_id, сохранённого в Telegram"""
+
+    def __init__(self):
+        self.file_ids = {}
+
+    async def load(self):
+        await db.ensure_file_ids_schema()
+        self.file_ids = await db.get_file_ids()
+
+    async def remember(self, url: str, message):
+        if not message or not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        if self.file_ids.get(url) == file_id:
+            return
+        self.file_ids[url] = file_id
+        try:
+            await db.save_file_id(url, file_id)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения file_id: {e}")
+
+    async def invalidate(self, urls):
+        urls = [url for url in urls if url in self.file_ids]
+        if not urls:
+            return
+        for url in urls:
+            self.file_ids.pop(url, None)
+        try:
+            await db.delete_file_ids(urls)
+        except Exception as e:
+            logging.error(f"Ошибка удаления file_id: {e}")
+
+    async def prune(self):
+        # Забываем картинки, которых больше нет ни в словах, ни в алфавите
+        if not catalog.by_id or not alphabet.snapshot:
+            return
+        active = {(word.get('image') or '').strip() for word in catalog.by_id.values()}
+        active.update(card['Изображение'].strip() for card in alphabet.snapshot)
+        await self.invalidate([url for url in self.file_ids if url not in active])
+
+
+file_ids = FileIdCache()
+
+
+async def reply_photo_cached(message, image_url: str, **kwargs):
+    """reply_photo, использующий file_id вместо URL, если картинка уже отправлялась"""
+    file_id = file_ids.file_ids.get(image_url)
+    if file_id:
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id устарел — отправляем по URL и запоминаем новый
+            logging.warning(f"Недействительный file_id для {image_url}: {e}")
+            await file_ids.invalidate([image_url])
+
+    sent = await message.reply_photo(photo=image_url, **kwargs)
+    await file_ids.remember(image_url, sent)
+    return sent
+
+
+
+# Настройки рассылки
+BROADCAST_WORKERS = 16        # Количество параллельных отправителей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 28))  # Сообщений в секунду на процесс (лимит Telegram ~30 на токен)
+BROADCAST_MAX_RETRIES = 3     # Повторы для одного чата при RetryAfter/таймаутах
+BROADCAST_CHECKPOINT_SIZE = 200     # Результатов отправки в одной контрольной точке
+BROADCAST_CHECKPOINT_INTERVAL = 5   # Секунд между контрольными точками
+BROADCAST_BATCH_SIZE = 1000         # Получателей в одной пачке очереди
+BROADCAST_LEASE = 120               # Секунд аренды пачки; продлевается контрольными точками
+BROADCAST_POLL_INTERVAL = 5         # Секунд между проверками очереди, когда она пуста
+
+# Ошибки BadRequest, после которых подписчика нужно удалить
+DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "bot was blocked")
+
+
+class TokenBucket:
+    """Глобальный ограничитель скорости отправки сообщений"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        # Маленький запас и пустой старт: ни в одну секунду не уходит больше rate (+1) сообщений
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        # Lock создаём в работающем цикле: ограничитель живёт в синглтоне, созданном при импорте
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # В новых версиях PTB retry_after может быть timedelta
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class Broadcaster:
+    """Пересылает сообщение подписчикам пулом воркеров с общим лимитом скорости.
+
+    Каждая рассылка — задание в broadcast_jobs, получатели которого разбиты на пачки
+    в broadcast_batches. Любое число процессов забирает пачки через FOR UPDATE SKIP LOCKED
+    и держит их по аренде: пачку упавшего процесса после истечения аренды продолжит
+    другой, начиная с ещё не отправленных получателей.
+    """
+
+    def __init__(self, workers: int = BROADCAST_WORKERS, rate: float = BROADCAST_RATE):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = None             # Задание создано в этом процессе — не ждём опроса
+        self.current = None            # (id задания, номер пачки) в работе
+        self.stats = {"sent": 0, "dead": 0, "failed": 0}
+        self.task = None
+
+    async def forward(self, bot, chat_id: int, from_chat_id, message_id: int):
+        # Возвращает "sent", "dead" или "failed"
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await bot.forward_message(
+                    chat_id=chat_id,
+                    from_chat_id=from_chat_id,
+                    message_id=message_id
+                )
+                return "sent"
+            except RetryAfter as e:
+                # Ждём только для этого чата, остальные воркеры продолжают работу
+                await asyncio.sleep(retry_after_seconds(e))
+            except Forbidden:
+                return "dead"
+            except BadRequest as e:
+                if any(reason in str(e).lower() for reason in DEAD_CHAT_ERRORS):
+                    return "dead"
+                logging.error(f"Ошибка рассылки для {chat_id}: {e}")
+                return "failed"
+            except (TimedOut, NetworkError) as e:
+                logging.warning(f"Сетевая ошибка для {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Ошибка рассылки для {chat_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def broadcast(self, source_chat: str, message_id: int):
+        """Ставит пост канала в очередь рассылки; повторный вызов для того же поста ничего не делает"""
+        job_id = await db.create_broadcast_job(source_chat, message_id, BROADCAST_BATCH_SIZE)
+        if job_id is None:
+            logging.info(f"Рассылка {message_id} уже создана, повтор пропускаем")
+            return
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run_batch(self, bot, job_id: int, batch_no: int, source_chat: str, message_id: int):
+        queue = asyncio.Queue()
+        for user_id in await db.get_batch_recipients(job_id, batch_no):
+            queue.put_nowait(user_id)
+
+        results = []
+        last_checkpoint = time.monotonic()
+
+        async def checkpoint():
+            nonlocal results, last_checkpoint
+            batch, results = results, []
+            last_checkpoint = time.monotonic()
+            if not batch:
+                return
+            try:
+                # Заодно продлеваем аренду пачки
+                await db.checkpoint_broadcast(job_id, batch_no, self.worker_id, batch, BROADCAST_LEASE)
+            except Exception as e:
+                # Вернём результаты в следующую контрольную точку
+                logging.error(f"Ошибка сохранения прогресса рассылки {job_id}: {e}")
+                results.extend(batch)
+
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                result = await self.forward(bot, chat_id, source_chat, message_id)
+                self.stats[result] += 1
+                results.append((chat_id, result))
+                if (len(results) >= BROADCAST_CHECKPOINT_SIZE
+                        or time.monotonic() - last_checkpoint >= BROADCAST_CHECKPOINT_INTERVAL):
+                    await checkpoint()
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.workers, queue.qsize()) or 1)))
+        finally:
+            # И при остановке бота сохраняем всё, что уже отправлено
+            await checkpoint()
+        if results:
+            # Пачку после истечения аренды заберёт этот или другой воркер
+            logging.error(f"Пачка {batch_no} рассылки {job_id} не завершена: прогресс не сохранён")
+            return
+        await db.finish_broadcast_batch(job_id, batch_no, self.worker_id)
+
+    async def run_forever(self, bot, stop_when_idle: bool = False):
+        # Event создаём в работающем цикле: на Python 3.9 созданный при импорте привязан к другому
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            try:
+                batch = await db.claim_broadcast_batch(self.worker_id, BROADCAST_LEASE)
+            except Exception as e:
+                logging.error(f"Ошибка получения пачки рассылки: {e}")
+                batch = None
+
+            if batch is None:
+                if stop_when_idle:
+                    return
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
+            self.current = (batch['job_id'], batch['batch_no'])
+            started = time.monotonic()
+            try:
+                await self.run_batch(bot, batch['job_id'], batch['batch_no'], batch['source_chat'], batch['message_id'])
+                logging.info(
+                    f"Рассылка {batch['message_id']}: пачка {batch['batch_no']} за {time.monotonic() - started:.1f} с"
+                )
+            except asyncio.CancelledError:
+                # Отдаём пачку сразу, не дожидаясь истечения аренды
+                try:
+                    await db.release_broadcast_batch(batch['job_id'], batch['batch_no'], self.worker_id)
+                except Exception as e:
+                    logging.error(f"Ошибка освобождения пачки рассылки: {e}")
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка рассылки {batch['job_id']}, пачка {batch['batch_no']}: {e}")
+            finally:
+                self.current = None
+
+    def start(self, bot):
+        # Задачу храним в self.task; её неожиданное завершение пишем в лог, а не теряем
+        self.task = asyncio.create_task(self.run_forever(bot))
+        self.task.add_done_callback(self.on_task_done)
+
+    @staticmethod
+    def on_task_done(task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Рассылка остановлена из-за ошибки: {task.exception()!r}")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+broadcaster = Broadcaster()
+
+
+@instrumented
 async def handle_channel_post(update: Update, context: CallbackContext):
     try:
         # Проверяем username канала (без @)
         if update.channel_post.chat.username.lower() != "topik2prep":
             return
             
-        subscribers = await db.get_subscribers()  # Асинхронный вызов
-        
-        for user_id in subscribers:
-            try:
-                await context.bot.forward_message(
-                    chat_id=user_id['user_id'],  # Исправлено: user_id из базы данных
-                    from_chat_id=update.channel_post.chat.id,
-                    message_id=update.channel_post.message_id
-                )
-            except Exception as e:
-                print(f"Ошибка для {user_id}: {e}")
-                await db.delete_subscriber(user_id['user_id'])  # Асинхронный вызов
+        # Получатели берутся из subscriptions при создании задания рассылки
+        await broadcaster.broadcast(SOURCE_CHANNEL_ID, update.channel_post.message_id)
         
     except Exception as e:
         print(f"Общая ошибка: {e}")
         
+# Отложенная отправка сообщений
+
+class MessagePacer:
+    """Отправляет серии сообщений с паузами в фоне, не занимая обработчик.
+
+    Серии одного чата выполняются по очереди, паузы — обычные таймеры event loop.
+    Перед ответом на новое сообщение чата серии досылаются без пауз (hurry) или
+    отменяются (cancel), чтобы отложенный текст не пришёл после свежего ответа.
+    """
+
+    def __init__(self):
+        self.tails = {}    # chat_id -> незавершённые серии по порядку
+        self.hurried = {}  # chat_id -> Event: оставшиеся паузы пропускаются
+
+    def schedule(self, chat_id: int, steps):
+        # steps: [(пауза перед отправкой, корутинная функция без аргументов), ...]
+        series = self.tails.setdefault(chat_id, [])
+        task = asyncio.create_task(self.run(chat_id, series[-1] if series else None, steps))
+        series.append(task)
+        task.add_done_callback(lambda t: self.forget(chat_id, t))
+        return task
+
+    def forget(self, chat_id: int, task):
+        series = self.tails.get(chat_id)
+        if series and task in series:
+            series.remove(task)
+        if not series:
+            self.tails.pop(chat_id, None)
+            self.hurried.pop(chat_id, None)
+
+    async def run(self, chat_id: int, previous, steps):
+        if previous:
+            await asyncio.wait([previous])
+        for delay, send in steps:
+            if delay:
+                await self.pause(chat_id, delay)
+            try:
+                await send()
+            except Exception as e:
+                logging.error(f"Ошибка отложенной отправки: {e}")
+
+    async def pause(self, chat_id: int, delay: float):
+        hurried = self.hurried.setdefault(chat_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(hurried.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def hurry(self, chat_id: int):
+        """Досылает серии чата без пауз и ждёт их отправки"""
+        series = self.tails.get(chat_id)
+        if not series:
+            return
+        self.hurried.setdefault(chat_id, asyncio.Event()).set()
+        await asyncio.wait(list(series))
+        self.hurried.pop(chat_id, None)  # Новые серии снова выдерживают паузы
+
+    def cancel(self, chat_id: int):
+        """Отменяет ещё не отправленные сообщения чата"""
+        for task in self.tails.pop(chat_id, []):
+            task.cancel()
+        self.hurried.pop(chat_id, None)
+
+    async def drain(self, timeout: float = 15):
+        # При остановке досылаем начатые серии без пауз
+        for chat_id in list(self.tails):
+            self.hurried.setdefault(chat_id, asyncio.Event()).set()
+        tasks = [task for series in self.tails.values() for task in series]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+pacer = MessagePacer()
+
+
+async def send_or_schedule(update: Update, delay: float, send):
+    if delay:
+        pacer.schedule(update.effective_chat.id, [(delay, send)])
+    else:
+        await send()
+
 # Авторизация Google Sheets
 scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
          "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
 
-# Используем service_account.json для авторизации
-creds = Credentials.from_service_account_file('credentials.json', scopes=scope)
-client = gspread.authorize(creds)
-spreadsheet = client.open("Корейский Алфавит")
-sheet = spreadsheet.get_worksheet(0)  # Первый лист таблицы
+SHEETS_ENABLED = os.getenv("SHEETS_ENABLED", "1") == "1"  # 0 — только локальная копия алфавита
+GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE", "credentials.json")
+
+
+def open_alphabet_sheet():
+    # Синхронные HTTPS-запросы: вызывается только из рабочего потока
+    creds = Credentials.from_service_account_file(GOOGLE_CREDENTIALS_FILE, scopes=scope)
+    client = gspread.authorize(creds)
+    spreadsheet = client.open("Корейский Алфавит")
+    return spreadsheet.get_worksheet(0)  # Первый лист таблицы
+
+# Снимок алфавита
+
+ALPHABET_COLUMNS = ("Буква", "Пример", "Транслит", "Перевод", "Звук", "Особенности", "Изображение")
+ALPHABET_CACHE_FILE = os.getenv("ALPHABET_CACHE_FILE", "alphabet_cache.json")
+ALPHABET_REFRESH_INTERVAL = 600  # Секунд между обновлениями из Google Sheets
+
+
+class AlphabetSource:
+    """Неизменяемый снимок листа с алфавитом, обновляемый в фоне"""
+
+    def __init__(self, cache_file: str = ALPHABET_CACHE_FILE):
+        self.cache_file = cache_file
+        self.snapshot = ()
+        self.by_letter = {}
+        self.sheet = None
+        self.refresh_task = None
+
+    @staticmethod
+    def freeze(records):
+        return tuple(
+            MappingProxyType({column: record.get(column, "") for column in ALPHABET_COLUMNS})
+            for record in records
+        )
+
+    def set_snapshot(self, records):
+        snapshot = self.freeze(records)
+        by_letter = {}
+        for card in snapshot:
+            letter = hangul.normalize(str(card["Буква"]))
+            if letter:
+                by_letter.setdefault(letter, card)
+        # Индекс и снимок меняем вместе
+        self.snapshot, self.by_letter = snapshot, MappingProxyType(by_letter)
+
+    def find_letters(self, text: str):
+        """Карточки букв для введённой буквы, слога или слова"""
+        text = hangul.normalize(text)
+        card = self.by_letter.get(text)
+        if card:
+            return [card]
+        cards = []
+        for jamo in hangul.jamo_letters(text):
+            card = self.by_letter.get(jamo)
+            if card:
+                cards.append(card)
+        return cards
+
+    def load_file(self):
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            # Повреждённая копия не должна мешать запуску: считаем, что её нет
+            logging.warning(f"Локальная копия алфавита повреждена, пропускаем: {e}")
+            return None
+        if not isinstance(records, list):
+            logging.warning("Локальная копия алфавита в неверном формате, пропускаем")
+            return None
+        return records
+
+    def save_file(self, records):
+        # Пишем во временный файл и атомарно подменяем: оборванная запись не портит копию
+        tmp_path = self.cache_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cache_file)
+
+    async def refresh(self):
+        # gspread синхронный, поэтому уводим запросы из event loop
+        if self.sheet is None:
+            self.sheet = await asyncio.to_thread(open_alphabet_sheet)
+        records = await asyncio.to_thread(self.sheet.get_all_records)
+        self.set_snapshot(records)
+        await file_ids.prune()
+        try:
+            await asyncio.to_thread(self.save_file, records)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить копию алфавита: {e}")
+
+    async def load_cached(self):
+        # Быстрый старт из локальной копии, Sheets подгружается позже в фоне
+        records = await asyncio.to_thread(self.load_file)
+        if records:
+            self.set_snapshot(records)
+        logging.info(f"Загружено букв из файла: {len(self.snapshot)}")
+
+    async def load(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.error(f"Google Sheets недоступен, используем локальную копию алфавита: {e}")
+            if not self.snapshot:
+                await self.load_cached()
+        logging.info(f"Загружено букв: {len(self.snapshot)}")
+
+    async def refresh_forever(self, interval: float = ALPHABET_REFRESH_INTERVAL):
+        await startup_phase("алфавит из Google Sheets", self.load())
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Оставляем прежний снимок до следующей попытки
+                logging.error(f"Ошибка обновления алфавита: {e}")
+
+    def start(self):
+        if SHEETS_ENABLED:
+            self.refresh_task = asyncio.create_task(self.refresh_forever())
+
+    async def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+
+
+alphabet = AlphabetSource()
 
 # Словарь для хранения прогресса пользователя
 user_progress = {}
@@ -129,6 +1478,7 @@ phrases_data = []
 # Настройка
 SOURCE_CHANNEL_ID = "@topik2prep"  # Канал-источник
 
+@instrumented
 async def unsubscribe(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     await db.delete_subscriber(user_id)  # Асинхронный вызов
@@ -141,22 +1491,15 @@ async def send_daily_post(context: CallbackContext):
         channel_id = "@topik2prep"
         posts = await context.bot.get_chat(chat_id=channel_id, limit=1)
         
-        # Получаем список подписчиков
-        subscribers = await db.get_subscribers()  # Асинхронный вызов
-        
-        # Пересылаем пост всем подписчикам
-        for user_id in subscribers:
-            await context.bot.forward_message(
-                chat_id=user_id['user_id'],  # Исправлено: user_id из базы данных
-                from_chat_id=channel_id,
-                message_id=posts[0].message_id
-            )
+        # Пересылаем пост всем подписчикам; повторный запуск для того же поста не дублирует его
+        await broadcaster.broadcast(channel_id, posts[0].message_id)
     except Exception as e:
         print(f"Ошибка: {e}")
 
 # Словарь для подписчиков
 subscribers = set()
 
+@instrumented
 async def return_to_menu(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     # Убираем удаление current_word_index
@@ -179,8 +1522,10 @@ async def return_to_menu(update: Update, context: CallbackContext):
         del context.user_data["mode"]
 
 
+@instrumented
 async def start(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
+    pacer.cancel(update.effective_chat.id)  # Серии прежнего раздела больше не нужны
     await db.add_subscriber(user_id)
     
     
@@ -225,14 +1570,14 @@ async def start(update: Update, context: CallbackContext):
     
     # Отправляем приветственное сообщение
     await update.message.reply_text(welcome_text0, reply_markup=reply_markup, parse_mode="HTML")
-    await asyncio.sleep(0.5)
-    await update.message.reply_text(welcome_text00, reply_markup=reply_markup, parse_mode="HTML")
-    await asyncio.sleep(1)
-    await update.message.reply_text(welcome_text1, reply_markup=reply_markup, parse_mode="HTML")
-    await asyncio.sleep(2)
-    await update.message.reply_text(welcome_text2, reply_markup=reply_markup, parse_mode="HTML")
+    pacer.schedule(update.effective_chat.id, [
+        (0.5, partial(update.message.reply_text, welcome_text00, reply_markup=reply_markup, parse_mode="HTML")),
+        (1, partial(update.message.reply_text, welcome_text1, reply_markup=reply_markup, parse_mode="HTML")),
+        (2, partial(update.message.reply_text, welcome_text2, reply_markup=reply_markup, parse_mode="HTML")),
+    ])
 
 
+@instrumented
 async def handle_spelling_input(update: Update, context: CallbackContext):
     user_input = update.message.text.strip()
     check_data = context.user_data.get("spelling_check")
@@ -253,10 +1598,17 @@ async def handle_spelling_input(update: Update, context: CallbackContext):
         await return_to_menu(update, context)
         return
 
-    if user_input == check_data['word']:
+    verdict = catalog.grade(check_data.get('word_id'), check_data['word'], user_input)
+    if verdict == hangul.EXACT:
         await update.message.reply_text("✅ Верно! Молодец!")
+        await grade_review(update.message.from_user.id, check_data, 5)
+    elif verdict == hangul.NEAR:
+        # Ошибка в одной-двух буквах: слово помнится, повторение откладывается ненадолго
+        await update.message.reply_text(f"🟡 Почти верно! Правильное написание: {check_data['word']}")
+        await grade_review(update.message.from_user.id, check_data, 3)
     else:
         await update.message.reply_text(f"❌ Неверно. Правильный ответ: {check_data['word']}")
+        await grade_review(update.message.from_user.id, check_data, 1)
 
     # Полностью сбрасываем состояние проверки и переходим в режим изучения
     context.user_data.pop("awaiting_spelling", None)
@@ -266,125 +1618,25 @@ async def handle_spelling_input(update: Update, context: CallbackContext):
     await send_word(update, context)
 
 
-async def handle_message(update: Update, context: CallbackContext):
-    user_input = update.message.text.strip()
-    user_id = update.message.from_user.id
-
-    # Обработка режима проверки написания в первую очередь
-    if context.user_data.get("mode") == "spelling_check":
-        await handle_spelling_input(update, context)
-        return
-
-    async def clear_user_state(context):
-        """Очищает состояние пользователя."""
-        keys_to_delete = [
-            "current_words", "current_word_index", "correct_translation",
-            "current_options", "awaiting_retry", "awaiting_letter_input",
-            "awaiting_dictionary_level", "awaiting_input"
-        ]
-        for key in keys_to_delete:
-            if key in context.user_data:
-                del context.user_data[key]
+TELEGRAM_MESSAGE_LIMIT = 4096  # Символов в одном текстовом сообщении
 
-    try:
-        # Проверяем команду "выйти" на самом начале
-        if user_input.lower() == "выйти":
-            await return_to_menu(update, context)
-            await clear_user_state(context)  # Очищаем все данные пользователя
-            return  # Завершаем выполнение, чтобы не продолжать обработку ввода
-            # Проверяем режимы
-        processed = False
-        if context.user_data.get("mode") == "learn":
-            processed = await check_word_translation(update, context)
-        elif context.user_data.get("mode") == "game":
-            processed = await check_game_translation(update, context)
-        elif context.user_data.get("mode") == "spelling_check":
-            if await handle_spelling_input(update, context):  # Проверка написания слов
-                return
-
-        if processed:
-            return  # Сообщение обработано, выходим
-
-        # Инициализируем прогресс пользователя, если его нет
-        user = await db.get_user(user_id)
-        if not user:
-            await db.create_user(user_id)
-            user = await db.get_user(user_id)
-
-        # Проверяем состояние ввода буквы/слова
-        if "awaiting_input" in context.user_data:  
-            await check_user_response(update, context)
-            return
-
-        # Если пользователь выбрал категорию
-        if user_input in ["Хангыль", "Разговорные фразы", "Грамматика", "Подготовка к ТОПИКу"]:
-            await clear_user_state(context)
-            await handle_choice(update, context)
-
-        elif user_input == "Мой словарь":
-            await clear_user_state(context)
-            await handle_my_dictionary(update, context)
-
-        elif user_input == "Учить новые слова":
-            await clear_user_state(context)
-            await handle_learn_new_words(update, context)
-
-        elif user_input == "Что за буква?":
-            await clear_user_state(context)
-            await handle_what_is_letter(update, context)
-
-        elif user_input == "Изучать буквы":
-            # Не перезаписываем существующий прогресс
-            if user_id not in user_progress:
-                user_progress[user_id] = {
-                    "current_letter_index": 0,
-                    "learned_words": [],
-                    "score": 0
-                }
-            elif "current_letter_index" not in user_progress[user_id]:
-                user_progress[user_id]["current_letter_index"] = 0
-
-            await send_letters_and_words(update, context, user_id)
-        elif user_input == "Играть еще раз 🔄":
-            await send_next_game_word(update, context)  # Перезапускаем игру
-            return
-
-        elif "awaiting_letter_input" in context.user_data and context.user_data["awaiting_letter_input"]:
-            await handle_letter_input(update, context)
-
-        elif user_input.lower() == "играть":
-            await handle_learn_from_dictionary(update, context)
-        elif user_input.lower() == "очистить словарь":
-            await handle_clear_dictionary(update, context)
-        elif "awaiting_spelling" in context.user_data:
-            await handle_spelling_input(update, context)  # Исправлено название
-
-        elif user_input.isdigit() and 1 <= int(user_input) <= 6:
-            if "current_words" in context.user_data:
-                await check_word_translation(update, context)
-            else:
-                # Если пользователь в разделе "Мой словарь", обрабатываем выбор уровня
-                if "awaiting_dictionary_level" in context.user_data:
-                    await handle_my_dictionary_level(update, context)
-                    if "awaiting_dictionary_level" in context.user_data:
-                        del context.user_data["awaiting_dictionary_level"]  # Очищаем состояние
-                else:
-                    await handle_learn_new_words_level(update, context)
-
-        elif "awaiting_retry" in context.user_data and context.user_data["awaiting_retry"]:
-            # Обработка повторного ввода после подсказки
-            await check_word_translation(update, context)
-
-        else:
-            # Если пользователь ввёл что-то неожиданное
-            await update.message.reply_text("Пожалуйста, выбери номер варианта или нажми 'Выйти'.")
-
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        await update.message.reply_text(f"Произошла ошибка: {e}")
 
+def join_within_limit(parts, separator: str, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    """Склеивает части в сообщения не длиннее limit, не разрывая части"""
+    messages = []
+    current = ""
+    for part in parts:
+        part = part[:limit]  # Одна карточка длиннее лимита не помещается целиком
+        if current and len(current) + len(separator) + len(part) > limit:
+            messages.append(current)
+            current = ""
+        current = current + separator + part if current else part
+    if current:
+        messages.append(current)
+    return messages
 
 
+@instrumented
 async def handle_letter_input(update: Update, context: CallbackContext): # Что за буква логика 
     user_input = update.message.text.strip()
 
@@ -393,34 +1645,36 @@ async def handle_letter_input(update: Update, context: CallbackContext): # Чт
         await return_to_menu(update, context)
         return
 
-    letters_data = await get_letters_data()
-    if not letters_data:
+    if not alphabet.snapshot:
         await update.message.reply_text("Ошибка при получении данных. Попробуйте позже.")
         return
 
-    # Ищем букву в данных
-    for letter_data in letters_data:
-        if letter_data['Буква'] == user_input:
-            letter = letter_data['Буква']
-            example_word = letter_data['Пример'].strip()
-            transliteration = letter_data['Транслит']
-            translation = letter_data['Перевод']
-            sound = letter_data['Звук']
-            features = letter_data['Особенности']
-
-            # Отправляем информацию о букве
-            await update.message.reply_text(
-                f"<b>Буква:</b> {letter} {sound}\n"
-                f"<b>Описание:</b> {features}\n"
-                f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}",
-                parse_mode="HTML"
-            )
-            return
+    # Ищем букву по индексу, слоги и слова раскладываем на буквы
+    cards = alphabet.find_letters(user_input)
+    if not cards:
+        await update.message.reply_text("Буква не найдена. Попробуй ещё раз.")
+        return
 
-    # Если буква не найдена
-    await update.message.reply_text("Буква не найдена. Попробуй ещё раз.")
+    descriptions = []
+    for letter_data in cards:
+        letter = letter_data['Буква']
+        example_word = letter_data['Пример'].strip()
+        transliteration = letter_data['Транслит']
+        translation = letter_data['Перевод']
+        sound = letter_data['Звук']
+        features = letter_data['Особенности']
+        descriptions.append(
+            f"<b>Буква:</b> {letter} {sound}\n"
+            f"<b>Описание:</b> {features}\n"
+            f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}"
+        )
 
+    # Отправляем информацию о буквах как можно меньшим числом сообщений
+    for text in join_within_limit(descriptions, "\n\n"):
+        await update.message.reply_text(text, parse_mode="HTML")
 
+
+@instrumented
 async def handle_what_is_letter(update: Update, context: CallbackContext): # Что за буква логика 2
     user_input = update.message.text.strip()
     
@@ -441,6 +1695,8 @@ async def handle_what_is_letter(update: Update, context: CallbackContext): # Ч
     keys_to_remove = [
         "current_words", 
         "current_word_index", 
+        "current_word_id",
+        "session_total",
         "correct_translation",
         "current_options", 
         "awaiting_retry"
@@ -459,14 +1715,15 @@ async def handle_what_is_letter(update: Update, context: CallbackContext): # Ч
 
 
 
+@instrumented
 async def send_letters_and_words(update: Update, context: CallbackContext, user_id: int):
-    letters_data = sheet.get_all_records()
+    letters_data = alphabet.snapshot
+    if not letters_data:
+        await update.message.reply_text("Ошибка при получении данных. Попробуйте позже.")
+        return
     
     # Получаем данные пользователя из базы данных
-    user = await db.get_user(user_id)
-    if not user:
-        await db.create_user(user_id)
-        user = await db.get_user(user_id)
+    user = await db.ensure_user(user_id)
     
     current_index = user['current_letter_index']
     
@@ -474,7 +1731,8 @@ async def send_letters_and_words(update: Update, context: CallbackContext, user_
         await update.message.reply_text("Вы изучили все буквы! 🎉")
         return
 
-    # Определяем категорию букв
+    # Определяем категорию букв: вступительные сообщения и паузы после них
+    intro = []
     if current_index < 10:  # Обычные гласные (2-11 строки)
         if current_index == 0:
             category_text0 = """<b>📚 Прежде чем начать изучение Хангыля, важно запомнить несколько правил:</b>"""
@@ -484,41 +1742,32 @@ async def send_letters_and_words(update: Update, context: CallbackContext, user_
     3. Помните, что произношение согласной зависит от положения в слове/слоге, «соседства» с другими буквами.
             """
             category_text2 ="""<b>Теперь давай начнем с первых букв:</b>"""
-            await update.message.reply_text(category_text0, parse_mode="HTML")
-            await asyncio.sleep(1)
-            await update.message.reply_text(category_text1, parse_mode="HTML")
-            await asyncio.sleep(12)
-            await update.message.reply_text(category_text2, parse_mode="HTML")
-            await asyncio.sleep(1)
+            intro = [(category_text0, 1), (category_text1, 12), (category_text2, 1)]
 
     elif current_index < 20:  # Обычные согласные (12-20 строки)
         if current_index == 10:
             category_text = """
             <b>Обычные согласные — это основные согласные звуки, которые часто используются в словах.</b>
             """
-            await update.message.reply_text(category_text, parse_mode="HTML")
-            await asyncio.sleep(1)
+            intro = [(category_text, 1)]
     elif current_index < 25:  # Придыхательные гласные (21-25 строки)
         if current_index == 20:
             category_text = """
             <b>Придыхательные гласные произносятся мягче обычных, но в целом они образуют уникальные звуки.</b>
             """
-            await update.message.reply_text(category_text, parse_mode="HTML")
-            await asyncio.sleep(1)
+            intro = [(category_text, 1)]
     elif current_index < 35:  # Дифтонги (26-36 строки)
         if current_index == 25:
             category_text = """
             <b>Дифтонги — сложные гласные, которые формируются из двух букв и произносятся как один звук.</b>
             """
-            await update.message.reply_text(category_text, parse_mode="HTML")
-            await asyncio.sleep(1)
+            intro = [(category_text, 1)]
     elif current_index < 41:  # Сдвоенные согласные (37-41 строки)
         if current_index == 35:
             category_text = """
             <b>Сдвоенные согласные — это буквы, которые произносятся в два раза сильнее обычных.</b>
             """
-            await update.message.reply_text(category_text, parse_mode="HTML")
-            await asyncio.sleep(1)
+            intro = [(category_text, 1)]
 
        # Получаем данные текущей буквы
     current_letter_data = letters_data[current_index]
@@ -537,44 +1786,59 @@ async def send_letters_and_words(update: Update, context: CallbackContext, user_
         "awaiting_input": "AWAITING_LETTER"  # Устанавливаем состояние ожидания буквы
     })
 
-    try:
-        # Отправляем изображение с описанием буквы
-        if image_url:
-            await update.message.reply_photo(
-                photo=image_url,
-                caption=f"<b>Изучи букву: {letter}</b> {sound}\n{features}",
-                parse_mode="HTML"
-            )
-            # Отправляем пример слова
-            await update.message.reply_text(
-                f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}\n\n",
-                parse_mode="HTML"
-            )
-        else:
-            await update.message.reply_text(f"<b>Изучи букву: {letter}</b>{sound} \n{features}", parse_mode="HTML")
-            # Отправляем пример слова
-            await update.message.reply_text(
-                f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}\n\n",
-                parse_mode="HTML"
-            )
+    async def send_letter_card():
+        try:
+            # Отправляем изображение с описанием буквы
+            if image_url:
+                await reply_photo_cached(
+                    update.message,
+                    image_url,
+                    caption=f"<b>Изучи букву: {letter}</b> {sound}\n{features}",
+                    parse_mode="HTML"
+                )
+                # Отправляем пример слова
+                await update.message.reply_text(
+                    f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}\n\n",
+                    parse_mode="HTML"
+                )
+            else:
+                await update.message.reply_text(f"<b>Изучи букву: {letter}</b>{sound} \n{features}", parse_mode="HTML")
+                # Отправляем пример слова
+                await update.message.reply_text(
+                    f"<b>Пример слова:</b> {example_word} ({transliteration}) — {translation}\n\n",
+                    parse_mode="HTML"
+                )
 
-        # Запрашиваем ввод буквы
-        await update.message.reply_text("➡️ Напиши эту букву:", parse_mode="HTML")
+            # Запрашиваем ввод буквы
+            await update.message.reply_text("➡️ Напиши эту букву:", parse_mode="HTML")
 
-        # Обновляем прогресс в БД
-        await db.update_progress(
-            user_id=user_id,
-            score=0,  # или добавляем очки если нужно
-            current_letter_index=current_index + 1
-        )
+        except Exception as e:
+            print(f"Ошибка отправки: {e}")
+            await update.message.reply_text("⚠️ Произошла ошибка при загрузке материалов")
+
+    # Прогресс обновляем сразу: повторное нажатие во время вступления не начнёт его заново
+    await db.update_progress(
+        user_id=user_id,
+        score=0,  # или добавляем очки если нужно
+        current_letter_index=current_index + 1
+    )
 
-    except Exception as e:
-        print(f"Ошибка отправки: {e}")
-        await update.message.reply_text("⚠️ Произошла ошибка при загрузке материалов")
+    if not intro:
+        await send_letter_card()
+        return
 
+    # Вступление с паузами отправляется планировщиком, обработчик не ждёт
+    steps = []
+    delay = 0
+    for text, pause in intro:
+        steps.append((delay, partial(update.message.reply_text, text, parse_mode="HTML")))
+        delay = pause
+    steps.append((delay, send_letter_card))
+    pacer.schedule(update.effective_chat.id, steps)
 
 
 
+@instrumented
 async def check_user_response(update: Update, context: CallbackContext):
     user_input = update.message.text.strip()  # Убираем лишние пробелы
     user_id = update.message.from_user.id
@@ -599,7 +1863,7 @@ async def check_user_response(update: Update, context: CallbackContext):
 
     # Проверяем, правильно ли пользователь ввел букву
     if "awaiting_input" in context.user_data and context.user_data["awaiting_input"] == "AWAITING_LETTER":
-        if user_input == correct_letter:  # Сравниваем без приведения к нижнему регистру
+        if hangul.grade_answer(user_input, hangul.answer_key(correct_letter)) == hangul.EXACT:
             await update.message.reply_text("✅ Правильно! Напиши пример слова.")
 
             # Переходим к следующему состоянию для ввода слова
@@ -610,12 +1874,10 @@ async def check_user_response(update: Update, context: CallbackContext):
 
     # Если буква была введена правильно, проверяем слово
     elif "awaiting_input" in context.user_data and context.user_data["awaiting_input"] == "AWAITING_WORD":
-        if user_input == correct_word:  # Сравниваем без приведения к нижнему регистру
+        verdict = hangul.grade_answer(user_input, hangul.answer_key(correct_word))
+        if verdict == hangul.EXACT:
             await update.message.reply_text("✅ Правильно! 🎉")
-            user = await db.get_user(user_id)
-            if not user:
-                await db.create_user(user_id)
-                user = await db.get_user(user_id)
+            user = await db.ensure_user(user_id)
 
             await db.update_progress(
                 user_id=user_id,
@@ -623,6 +1885,8 @@ async def check_user_response(update: Update, context: CallbackContext):
                 current_letter_index=user['current_letter_index'] + 1
             )
             await send_letters_and_words(update, context, user_id)
+        elif verdict == hangul.NEAR:
+            await update.message.reply_text(f"🟡 Почти! Проверь буквы и напиши ещё раз: {correct_word}")
         else:
             await update.message.reply_text(f"❌ Неправильно. Попробуй ещё раз: Напиши слово: {correct_word}")
 
@@ -631,21 +1895,19 @@ async def check_user_response(update: Update, context: CallbackContext):
 
 
 # Модифицированные функции
+@instrumented
 async def handle_my_dictionary(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
 
-    async with db.pool.acquire() as conn:
-        # Получаем уникальные уровни изученных слов
-        levels = await conn.fetch(
-            "SELECT DISTINCT wt.level FROM words_table wt JOIN users u ON wt.id::TEXT = ANY(u.learned_words) WHERE u.user_id = $1",
-            user_id
-        )
+    # Получаем уникальные уровни изученных слов
+    await progress_buffer.flush(user_id)  # Учитываем ещё не записанные слова
+    levels = await db.get_learned_levels(user_id)
 
     if not levels:
         await update.message.reply_text("Вы пока не изучили ни одного слова. 😢")
         return
 
-    keyboard = [[str(level['level'])] for level in sorted(levels, key=lambda x: x['level'])]
+    keyboard = [[str(level['level'])] for level in levels]
     keyboard.append(["Выйти"])
     
     await update.message.reply_text(
@@ -654,47 +1916,70 @@ async def handle_my_dictionary(update: Update, context: CallbackContext):
     )
     context.user_data["awaiting_dictionary_level"] = True
 
+DICTIONARY_PAGE_SIZE = 20
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(learned_at: datetime) -> int:
+    # Время в микросекундах помещается в callback_data (до 64 байт)
+    return (learned_at - EPOCH) // timedelta(microseconds=1)
+
+
+def decode_cursor(value: str) -> datetime:
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+async def render_dictionary_page(user_id: int, level: int, total: int, direction: str = None,
+                                 cursor: tuple = None, rank: int = 0):
+    """Текст и кнопки страницы словаря; rank — сколько более новых слов пропущено"""
+    # total считается один раз при открытии словаря и едет в кнопках: нумерация не сдвигается между страницами
+    if cursor:
+        rows = await db.get_dictionary_page(user_id, level, DICTIONARY_PAGE_SIZE, direction, *cursor)
+    else:
+        rows = await db.get_dictionary_page(user_id, level, DICTIONARY_PAGE_SIZE)
+    if not rows:
+        return None, None
+
+    # Строки идут от новых к старым, показываем в порядке изучения
+    word_list = "\n".join(
+        f"{total - rank - idx}. {w['word']} — {w['translation']}"
+        for idx, w in reversed(list(enumerate(rows)))
+    )
+    text = (
+        f"📖 Слова {total - rank - len(rows) + 1}–{total - rank} из {total}:\n{word_list}"
+    )
+
+    buttons = []
+    oldest, newest = rows[-1], rows[0]
+    if rank + len(rows) < total:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Раньше",
+            callback_data=f"dict:older:{level}:{encode_cursor(oldest['learned_at'])}:{oldest['word_id']}:{rank + len(rows)}:{total}"
+        ))
+    if rank > 0:
+        buttons.append(InlineKeyboardButton(
+            "Позже ➡️",
+            callback_data=f"dict:newer:{level}:{encode_cursor(newest['learned_at'])}:{newest['word_id']}:{max(0, rank - DICTIONARY_PAGE_SIZE)}:{total}"
+        ))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@instrumented
 async def handle_my_dictionary_level(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     level = int(update.message.text)
 
-    async with db.pool.acquire() as conn:
-        # Получаем все слова уровня из БД
-        words = await conn.fetch(
-            "SELECT * FROM words_table WHERE level = $1", 
-            level
-        )
-        
-        # Получаем изученные слова пользователя для этого уровня
-        learned_words = await conn.fetch(
-            """
-            SELECT wt.* 
-            FROM words_table wt
-            JOIN users u ON wt.id::TEXT = ANY(u.learned_words) 
-            WHERE u.user_id = $1 AND wt.level = $2
-            """,
-            user_id, level
-        )
+    # Количество и первая страница считаются в SQL
+    await progress_buffer.flush(user_id)
+    total_learned = await db.count_learned_words(user_id, level)
 
-    if not learned_words:
+    if not total_learned:
         await update.message.reply_text(f"На уровне {level} пока нет изученных слов.")
         return
 
-    # Рассчитываем статистику
-    total_learned = len(learned_words)
-    offset = max(0, total_learned - 20)
-    last_20_words = learned_words[-20:]
-
-    # Формируем сообщение
-    word_list = "\n".join(
-        [f"{idx+1+offset}. {w['word']} — {w['translation']}" 
-         for idx, w in enumerate(last_20_words)]
-    )
-    
     stats_message = (
         f"📚 Уровень {level}\n"
-        f"📊 Изучено слов: {total_learned}\n\n"
-        f"📖 Последние 20 изученных слов:\n{word_list}"
+        f"📊 Изучено слов: {total_learned}"
     )
 
     await update.message.reply_text(
@@ -705,12 +1990,31 @@ async def handle_my_dictionary_level(update: Update, context: CallbackContext):
         )
     )
 
+    text, markup = await render_dictionary_page(user_id, level, total_learned)
+    if text:
+        await update.message.reply_text(text, reply_markup=markup)
+
     # Сохраняем контекст для возможной игры
-    context.user_data.update({
-        "current_level": level,
-        "current_words": learned_words
-    })
+    context.user_data["current_level"] = level
+
+
+@instrumented
+async def handle_dictionary_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        _, direction, level, cursor_at, cursor_id, rank, total = query.data.split(":")
+        cursor = (decode_cursor(cursor_at), int(cursor_id))
+        level, rank, total = int(level), int(rank), int(total)
+    except ValueError:
+        return
 
+    text, markup = await render_dictionary_page(query.from_user.id, level, total, direction, cursor, rank)
+    if text:
+        await query.edit_message_text(text, reply_markup=markup)
+
+@instrumented
 async def handle_clear_dictionary(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     await clear_learned_words(user_id)
@@ -723,12 +2027,28 @@ async def handle_clear_dictionary(update: Update, context: CallbackContext):
 
 
 
+@instrumented
 async def handle_learn_new_words(update: Update, context: CallbackContext):
     # Создаем клавиатуру с уровнями и кнопкой "Выйти"
     keyboard = [["1", "2", "3"], ["4", "5", "6"], ["Выйти"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Выберите уровень слов или нажмите 'Выйти':", reply_markup=reply_markup)
 
+LEARN_WINDOW_SIZE = 20  # Сколько следующих id слов урока хранится в состоянии пользователя
+
+
+def next_learning_window(level: int, learned_set: set) -> list:
+    # Новая случайная выборка неизученных слов уровня из общего кэша
+    window = []
+    for word in catalog.shuffled_level(level):
+        if word['id'] not in learned_set:
+            window.append(word['id'])
+            if len(window) == LEARN_WINDOW_SIZE:
+                break
+    return window
+
+
+@instrumented
 async def handle_learn_new_words_level(update: Update, context: CallbackContext):
     user_input = update.message.text.strip()
     
@@ -744,119 +2064,95 @@ async def handle_learn_new_words_level(update: Update, context: CallbackContext)
     user_id = update.message.from_user.id
 
     try:
-        async with db.pool.acquire() as conn:
-            # Получаем слова уровня
-            words = await conn.fetch(
-                "SELECT * FROM words_table WHERE level = $1 ORDER BY st_imp DESC, random()",
-                level
-            )
+        # Слова уровня берём из кэша в случайном порядке внутри st_imp
+        words = catalog.shuffled_level(level)
 
-            if not words:
-                await update.message.reply_text(f"На уровне {level} пока нет слов. 😢")
-                return
+        await progress_buffer.flush(user_id)  # Сохранённая позиция могла ещё не записаться
 
-            # Получаем данные пользователя
-            user_data = await conn.fetchrow(
-                """SELECT learned_words, 
-                COALESCE(learning_progress, '{}'::JSONB) as learning_progress 
-                FROM users WHERE user_id = $1""",
-                user_id
-            )
-            
-            # Инициализируем прогресс
-            learning_progress = user_data['learning_progress'] if user_data else {}
-            if isinstance(learning_progress, str):  # Защита от строкового представления
-                try:
-                    learning_progress = json.loads(learning_progress)
-                except:
-                    learning_progress = {}
+        if not words:
+            await update.message.reply_text(f"На уровне {level} пока нет слов. 😢")
+            return
 
-            level_progress = learning_progress.get(str(level), {'index': 0, 'words': []})
-            
-            learned_words = user_data['learned_words'] if user_data else []
-            learned_set = set(learned_words)
+        # Получаем сохранённый прогресс пользователя
+        learning_progress = await db.get_learning_progress(user_id)
+        level_progress = learning_progress.get(str(level), {'index': 0})
 
-            # Фильтруем новые слова
-            filtered_words = [
-                word for word in words 
-                if str(word['id']) not in learned_set
-            ]
+        learned_set = await db.get_learned_word_ids(user_id) | progress_buffer.pending_word_ids(user_id)
 
-            if not filtered_words:
-                await update.message.reply_text(f"Вы уже изучили все слова уровня {level}! 🎉")
-                return
+        # Фильтруем новые слова
+        filtered_ids = [
+            word['id'] for word in words 
+            if word['id'] not in learned_set
+        ]
+
+        if not filtered_ids:
+            await update.message.reply_text(f"Вы уже изучили все слова уровня {level}! 🎉")
+            return
 
-            # Начинаем с сохраненной позиции
-            start_index = level_progress.get('index', 0)
-            if start_index >= len(filtered_words):
-                start_index = 0
+        # Начинаем с сохраненной позиции
+        start_index = level_progress.get('index', 0)
+        if start_index >= len(filtered_ids):
+            start_index = 0
 
-            # Сохраняем контекст
-            context.user_data.update({
-                "current_words": filtered_words,
-                "current_word_index": start_index,
-                "current_level": level
-            })
+        # В состоянии держим только окно следующих id, размер не зависит от уровня
+        context.user_data.update({
+            "current_words": filtered_ids[start_index:start_index + LEARN_WINDOW_SIZE],
+            "current_word_index": start_index,
+            "current_level": level,
+            "session_total": len(filtered_ids)
+        })
 
-            # Отправляем первое слово
-            await send_word(update, context)
-            context.user_data["mode"] = "learn"
+        # Отправляем первое слово
+        await send_word(update, context)
+        context.user_data["mode"] = "learn"
 
     except Exception as e:
         logging.error(f"Ошибка при работе с базой данных: {e}")
         await update.message.reply_text("⚠ Произошла ошибка. Попробуйте позже.")
 
+@instrumented
 async def send_word(update, context):
     user_id = update.message.from_user.id
     index = context.user_data.get("current_word_index", 0)
-    words = context.user_data.get("current_words", [])
+    window = context.user_data.get("current_words", [])
     level = context.user_data.get("current_level")
 
-    if index >= len(words):
+    if not window and level is not None:
+        # Окно закончилось — добираем следующие неизученные слова уровня
+        learned_set = await db.get_learned_word_ids(user_id) | progress_buffer.pending_word_ids(user_id)
+        window = next_learning_window(level, learned_set)
+
+    # Слова, удалённые из words_table после начала урока, пропускаем
+    word = None
+    while window and word is None:
+        word = catalog.get(window[0])
+        window = window[1:]
+
+    context.user_data["current_words"] = window
+    if word is None:
         await update.message.reply_text("Вы изучили все слова! 🎉")
         return
 
-    # Сохраняем прогресс
-    async with db.pool.acquire() as conn:
-        try:
-            await conn.execute("""
-                UPDATE users 
-                SET learning_progress = 
-                    COALESCE(learning_progress, '{}'::JSONB) || 
-                    jsonb_build_object($1::TEXT, 
-                        jsonb_build_object(
-                            'index', $2::INTEGER,
-                            'words', $3::JSONB
-                        )
-                    )
-                WHERE user_id = $4
-            """, 
-            str(level),
-            index,
-            json.dumps([str(w['id']) for w in words[:index]]),
-            user_id)
-        except Exception as e:
-            logging.error(f"Ошибка сохранения прогресса: {e}")
+    # Сохраняем прогресс (запишется пакетом)
+    progress_buffer.set_position(user_id, level, index)
 
-    
-    word = words[index]
     correct_translation = word['translation']
     image_url = (word.get('image') or '').strip()
+    total = max(context.user_data.get("session_total", 0), index + 1)
     
     try:
         if image_url:
-            await update.message.reply_photo(photo=image_url, caption=f"<b>Изучим слово:</b> {word['word']}", parse_mode="HTML")
+            await reply_photo_cached(update.message, image_url, caption=f"<b>Изучим слово:</b> {word['word']}", parse_mode="HTML")
         else:
             await update.message.reply_text(f"<b>Изучим слово:</b> {word['word']}", parse_mode="HTML")
         
-        all_translations = [w['translation'] for w in words if w['translation'] != correct_translation]
-        random.shuffle(all_translations)
-        options = [correct_translation] + all_translations[:2]
+        options = [correct_translation] + catalog.distractors(word, 2)
         random.shuffle(options)
         
         context.user_data.update({
             "correct_translation": correct_translation,
-            "current_options": options
+            "current_options": options,
+            "current_word_id": word['id']
         })
         
         keyboard = [[str(i + 1) for i in range(len(options))], ["Выйти"]]
@@ -867,7 +2163,7 @@ async def send_word(update, context):
             f"<b>Слово:</b> {word['word']}\n\n"
             f"<b>Варианты:</b>\n{options_text}\n\n"
             f"Выбери правильный перевод (введи номер) или нажми 'Выйти':\n\n"
-            f"Прогресс: {index + 1} из {len(words)} слов 🚀",
+            f"Прогресс: {index + 1} из {total} слов 🚀",
             parse_mode="HTML",
             reply_markup=reply_markup
         )
@@ -884,6 +2180,39 @@ async def send_word(update, context):
 # Добавляем в начало константы
 INTERACTIVE_CHECK_INTERVAL = 3  # Проверка каждые 3 слова
 
+# Интервальное повторение (SM-2)
+REVIEW_MIN_EASE = 1.3
+REVIEW_RETRY_DELAY = timedelta(minutes=10)  # Ошибочное слово возвращается в ту же сессию
+
+
+def sm2_schedule(quality: int, ease: float, interval_days: float, repetitions: int):
+    """Новые (ease, interval_days, repetitions, due_at) по оценке ответа 0..5"""
+    ease = max(REVIEW_MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    now = datetime.now(timezone.utc)
+    if quality < 3:
+        return ease, 0.0, 0, now + REVIEW_RETRY_DELAY
+
+    if repetitions == 0:
+        interval_days = 1.0
+    elif repetitions == 1:
+        interval_days = 6.0
+    else:
+        interval_days = interval_days * ease
+    return ease, interval_days, repetitions + 1, now + timedelta(days=interval_days)
+
+
+async def grade_review(user_id: int, check_data: dict, quality: int):
+    if check_data.get("word_id") is None:
+        return
+    ease, interval_days, repetitions, due_at = sm2_schedule(
+        quality, check_data["ease"], check_data["interval_days"], check_data["repetitions"]
+    )
+    try:
+        await db.save_review(user_id, check_data["word_id"], ease, interval_days, repetitions, due_at)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения повторения: {e}")
+
+@instrumented
 async def check_word_translation(update: Update, context: CallbackContext):
     if context.user_data.get("mode") != "learn":
         return False
@@ -896,7 +2225,7 @@ async def check_word_translation(update: Update, context: CallbackContext):
         await return_to_menu(update, context)
         return True
 
-    if "current_options" not in context.user_data or "correct_translation" not in context.user_data:
+    if not all(key in context.user_data for key in ("current_options", "correct_translation", "current_word_id")):
         await update.message.reply_text("Ошибка: данные не найдены. Попробуй ещё раз.")
         return True
 
@@ -911,47 +2240,28 @@ async def check_word_translation(update: Update, context: CallbackContext):
 
         selected_translation = options[selected_option]
 
-        async with db.pool.acquire() as conn:
-            user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-            if not user:
-                await conn.execute("INSERT INTO users(user_id) VALUES($1)", user_id)
-                user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-
-            if selected_translation == correct_translation:
-                current_word = context.user_data["current_words"][context.user_data["current_word_index"] - 1]
-                
-                # Обновляем прогресс в базе данных
-                await conn.execute(
-                    """
-                    UPDATE users 
-                    SET 
-                        score = COALESCE(score, 0) + 10,
-                        learned_words = array_append(learned_words, $1)
-                    WHERE user_id = $2
-                    """,
-                    str(current_word['id']),  # Добавляем ID слова в learned_words
-                    user_id
-                )
-
-                await update.message.reply_text(
-                    f"✅ Правильно! Слово добавлено в твой словарь!\n"
-                    f"💯 Твой счёт: {user.get('score', 0) + 10} баллов."
-                )
+        if selected_translation == correct_translation:
+            # Обновляем прогресс через буфер, без запросов на каждый ответ
+            progress_buffer.add_score(user_id, 10)
+            progress_buffer.add_learned_word(user_id, context.user_data["current_word_id"])  # Добавляем слово в словарь
+            score = await progress_buffer.get_score(user_id)
 
-                if context.user_data["current_word_index"] % 3 == 0:
-                    await start_spelling_check(update, context)
-                else:
-                    await send_word(update, context)
+            await update.message.reply_text(
+                f"✅ Правильно! Слово добавлено в твой словарь!\n"
+                f"💯 Твой счёт: {score} баллов."
+            )
 
+            if context.user_data["current_word_index"] % INTERACTIVE_CHECK_INTERVAL == 0:
+                await start_spelling_check(update, context)
             else:
-                await conn.execute(
-                    "UPDATE users SET score = COALESCE(score, 0) - 5 WHERE user_id = $1",
-                    user_id
-                )
-                hint = f"Подсказка: первая буква — '{correct_translation[0]}'."
-                await update.message.reply_text(
-                    f"❌ Неправильно. {hint}\nПопробуй ещё раз:"
-                )
+                await send_word(update, context)
+
+        else:
+            progress_buffer.add_score(user_id, -5)
+            hint = f"Подсказка: первая буква — '{correct_translation[0]}'."
+            await update.message.reply_text(
+                f"❌ Неправильно. {hint}\nПопробуй ещё раз:"
+            )
 
     except (ValueError, IndexError):
         await update.message.reply_text("Пожалуйста, выбери номер правильного варианта.")
@@ -962,38 +2272,37 @@ async def check_word_translation(update: Update, context: CallbackContext):
     return True
 
 
+@instrumented
 async def start_spelling_check(update: Update, context: CallbackContext): # Проверка каждого 3-4 слова изученного подряд
-    # Получаем последние 3-4 изученных слова
+    # Выбираем слово для повторения из изученных
     user_id = update.message.from_user.id
     
-    async with db.pool.acquire() as conn:
-        words = await conn.fetch(
-            """
-            SELECT wt.* 
-            FROM words_table wt
-            JOIN users u ON wt.id::TEXT = ANY(u.learned_words)
-            WHERE u.user_id = $1
-            ORDER BY random()
-            LIMIT $2
-            """,
-            user_id, INTERACTIVE_CHECK_INTERVAL
-        )
+    await progress_buffer.flush(user_id)
+    # Берём слово, которому раньше всех пора на повторение
+    words = await db.get_due_reviews(user_id, 1)
 
     if not words:
+        # Повторять пока нечего — продолжаем урок
+        await send_word(update, context)
         return
 
-    check_word = random.choice(words)
+    check_word = words[0]
 
     context.user_data["spelling_check"] = {
+        "word_id": check_word['id'],
         "word": check_word['word'],
         "translation": check_word['translation'],
-        "image": check_word.get('image', '')
+        "image": check_word.get('image', ''),
+        "ease": check_word['ease'],
+        "interval_days": check_word['interval_days'],
+        "repetitions": check_word['repetitions']
     }
 
     # Отправляем картинку
     if check_word.get('image'):
-        await update.message.reply_photo(
-            photo=check_word['image'],
+        await reply_photo_cached(
+            update.message,
+            check_word['image'].strip(),
             caption="📝 Напиши это слово на корейском:",
             parse_mode="HTML"
         )
@@ -1011,53 +2320,26 @@ async def start_spelling_check(update: Update, context: CallbackContext): # Пр
 # Новая функция для обработки ввода при проверке написания
 
 
-async def get_learned_words(user_id: int, level: int = None):
-    async with db.pool.acquire() as conn:
-        query = """
-            SELECT wt.* 
-            FROM words_table wt
-            JOIN users u ON wt.id::TEXT = ANY(u.learned_words)
-            WHERE u.user_id = $1
-        """
-        params = [user_id]
-        
-        if level:
-            query += " AND wt.level = $2"
-            params.append(level)
-            
-        return await conn.fetch(query, *params)
-
 async def clear_learned_words(user_id: int):
-    async with db.pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET learned_words = '{}' WHERE user_id = $1",
-            user_id
-        )
+    progress_buffer.discard_learned_words(user_id)
+    await db.clear_learned_words(user_id)
 
 
+@instrumented
 async def handle_learn_from_dictionary(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
 
-    # Загружаем слова из базы данных (то, что пользователь уже учил)
-    learned_words = await get_learned_words_from_db(user_id)
+    # Сессию собирает один запрос: перемешанные id изученных слов выбранного уровня
+    await progress_buffer.flush(user_id)
+    word_ids = await db.get_game_word_ids(user_id, context.user_data.get("current_level"))
 
-    # Загружаем текущий список слов из Google Sheets или других источников
-    sheet_words = context.user_data.get("current_words", [])
-
-    # Объединяем оба списка, исключая дубликаты
-    all_words = {word["word"]: word for word in (sheet_words + learned_words)}.values()
-    all_words = list(all_words)  # Преобразуем обратно в список
-
-    if not all_words:
+    if not word_ids:
         await update.message.reply_text("❌ Нет слов для игры. Выберите другой уровень.")
         return
 
-    # Перемешиваем слова для случайного порядка
-    random.shuffle(all_words)
-
-    # Сохраняем обновленный список слов
+    # В состоянии храним только id и позицию, сами слова берём из общего кэша
     context.user_data.update({
-        "game_words": all_words,
+        "game_words": word_ids,
         "current_game_index": 0,
         "correct_answers": 0,
         "in_game": True
@@ -1076,35 +2358,43 @@ async def handle_learn_from_dictionary(update: Update, context: CallbackContext)
     )
 
     await send_next_game_word(update, context)
-    context.user_data["mode"] = "game"
+    if context.user_data.get("in_game"):  # Игра могла сразу завершиться, если слов нет в кэше
+        context.user_data["mode"] = "game"
 
 
 
-async def send_next_game_word(update: Update, context: CallbackContext):
+@instrumented
+async def send_next_game_word(update: Update, context: CallbackContext, delay: float = 0):
     words = context.user_data.get("game_words", [])
     index = context.user_data.get("current_game_index", 0)
 
-    if index >= len(words):
-        await finish_game(update, context)
+    # Слова, удалённые из words_table после начала игры, пропускаем
+    word = None
+    while index < len(words) and word is None:
+        word = catalog.get(words[index])
+        index += 1
+
+    if word is None:
+        await finish_game(update, context, delay)
         return
-    
-    word = words[index]
-    
+
     # Сохраняем текущие данные в context
     context.user_data.update({
-        "current_word": word,
+        "current_word_id": word['id'],
         "current_correct": word["word"],
-        "current_game_index": index + 1
+        "current_game_index": index
     })
     
-    await update.message.reply_text(
+    text = (
         f"Слово: {word['translation']}\n"
         f"📝 Уровень: {word.get('level', 'Неизвестно')}\n\n"
-        "✏️ Напиши перевод на корейском:",
-        parse_mode="HTML"
+        "✏️ Напиши перевод на корейском:"
     )
+    # Состояние уже обновлено, поэтому само сообщение можно отправить позже
+    await send_or_schedule(update, delay, partial(update.message.reply_text, text, parse_mode="HTML"))
 
 
+@instrumented
 async def check_game_translation(update: Update, context: CallbackContext):
     if context.user_data.get("mode") != "game":
         return False  
@@ -1113,12 +2403,11 @@ async def check_game_translation(update: Update, context: CallbackContext):
 
     # Проверяем, не нажал ли пользователь кнопку "Стоп"
     if user_input == "Стоп 🛑":
-        context.user_data["mode"] = None  
-        await finish_game(update, context)
+        await stop_game(update, context)
         return True
 
     # Проверяем, есть ли текущее слово
-    current_word = context.user_data.get("current_word")
+    current_word = catalog.get(context.user_data.get("current_word_id") or 0)
     if not current_word:
         await update.message.reply_text("⚠ Ошибка! Нет текущего слова.")
         return True
@@ -1130,8 +2419,8 @@ async def check_game_translation(update: Update, context: CallbackContext):
         await update.message.reply_text("✏️ Напиши перевод на корейском: ")
         return True
 
-    # Проверка ответа (без нормализации)
-    if user_input == correct:
+    verdict = catalog.grade(current_word['id'], correct, user_input)
+    if verdict == hangul.EXACT:
         context.user_data["correct_answers"] += 1
         example_list = current_word.get("examples") or ["(Нет примера)"]
         example = random.choice(example_list)
@@ -1140,6 +2429,11 @@ async def check_game_translation(update: Update, context: CallbackContext):
             f"🇰🇷 Ответ: {correct}\n"
             f"💡 Пример: {example}"
         )
+    elif verdict == hangul.NEAR:
+        msg = (
+            f"🟡 Почти! Ошибка в одной-двух буквах.\n"
+            f"🇰🇷 Правильно: {correct}"
+        )
     else:
         romanization = current_word.get("romanization", "Нет транскрипции") or "Нет транскрипции"
         msg = (
@@ -1148,12 +2442,19 @@ async def check_game_translation(update: Update, context: CallbackContext):
         )
     
     await update.message.reply_text(msg)
-    await asyncio.sleep(1.5)  
-    await send_next_game_word(update, context)
+    await send_next_game_word(update, context, delay=1.5)
     return True
 
 
-async def finish_game(update: Update, context: CallbackContext):
+async def stop_game(update: Update, context: CallbackContext):
+    # Следующее слово могло ещё не уйти — после итогов игры оно не нужно
+    pacer.cancel(update.effective_chat.id)
+    context.user_data["mode"] = None
+    await finish_game(update, context)
+
+
+@instrumented
+async def finish_game(update: Update, context: CallbackContext, delay: float = 0):
     correct = context.user_data.get("correct_answers", 0)
     total = len(context.user_data.get("game_words", []))
     
@@ -1168,7 +2469,8 @@ async def finish_game(update: Update, context: CallbackContext):
         emoji = "💪"
         comment = "Хорошая попытка! Продолжай практиковаться!"
     
-    await update.message.reply_text(
+    await send_or_schedule(update, delay, partial(
+        update.message.reply_text,
         f"{emoji} Игра завершена!\n\n"
         f"📊 Результат: {correct} из {total}\n"
         f"{comment}\n\n"
@@ -1177,14 +2479,15 @@ async def finish_game(update: Update, context: CallbackContext):
             [["Играть еще раз 🔄", "Выйти"]], 
             resize_keyboard=True
         )
-    )
+    ))
 
     # Сброс состояния игры
     context.user_data.pop("mode", None)
-    for key in ["game_words", "current_game_index", "correct_answers", "in_game"]:
+    for key in ["game_words", "current_game_index", "current_word_id", "current_correct", "correct_answers", "in_game"]:
         context.user_data.pop(key, None)
 
 
+@instrumented
 async def handle_choice(update: Update, context: CallbackContext):
     user_choice = update.message.text
     user_id = update.message.from_user.id
@@ -1197,10 +2500,7 @@ async def handle_choice(update: Update, context: CallbackContext):
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
         # Сохраняем прогресс, если он уже есть
-        user = await db.get_user(user_id)
-        if not user:
-            await db.create_user(user_id)
-            user = await db.get_user(user_id)
+        await db.ensure_user(user_id)
 
         await update.message.reply_text( 
             """
@@ -1230,25 +2530,16 @@ async def handle_choice(update: Update, context: CallbackContext):
 
 async def clear_user_state(context: CallbackContext):
     keys_to_remove = [
-        "current_words", "current_word_index", "correct_translation",
+        "current_words", "current_word_index", "current_word_id", "session_total", "correct_translation",
         "current_options", "awaiting_retry", "awaiting_letter_input",
-        "awaiting_dictionary_level"
+        "awaiting_dictionary_level", "awaiting_input"
     ]
     for key in keys_to_remove:
         if key in context.user_data:
             del context.user_data[key]
 
-async def get_letters_data():
-    try:
-        return await db.pool.fetch("SELECT * FROM korean_alphabet ORDER BY id")
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных из БД: {e}")
-        await asyncio.sleep(1)  # Пауза перед повторной попыткой
-        return None
-
-
-
 # Добавляем команду для обнуления счёта
+@instrumented
 async def reset_score(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
 
@@ -1259,23 +2550,515 @@ async def reset_score(update: Update, context: CallbackContext):
     else:
         await update.message.reply_text("У вас пока нет счёта для обнуления. 😢")
 
+
+# Маршрутизация текстовых сообщений
+
+MENU_CATEGORIES = ("Хангыль", "Разговорные фразы", "Грамматика", "Подготовка к ТОПИКу")
+WORD_LEVELS = tuple(str(level) for level in range(1, 7))
+
+
+def message_state(user_data) -> str:
+    """Состояние диалога, по которому выбирается таблица маршрутов"""
+    mode = user_data.get("mode")
+    if mode in ("spelling_check", "learn", "game"):
+        return mode
+    if user_data.get("awaiting_input"):
+        return "letters"
+    if user_data.get("awaiting_letter_input"):
+        return "what_letter"
+    if user_data.get("awaiting_dictionary_level"):
+        return "dictionary_level"
+    return "menu"
+
+
+def resetting(handler):
+    # Кнопки меню начинают новый раздел с чистого состояния
+    async def route(update: Update, context: CallbackContext):
+        await clear_user_state(context)
+        await handler(update, context)
+    return route
+
+
+async def exit_to_menu(update: Update, context: CallbackContext):
+    await return_to_menu(update, context)
+    await clear_user_state(context)
+
+
+async def start_letters(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    # Не перезаписываем существующий прогресс
+    if user_id not in user_progress:
+        user_progress[user_id] = {
+            "current_letter_index": 0,
+            "learned_words": [],
+            "score": 0
+        }
+    elif "current_letter_index" not in user_progress[user_id]:
+        user_progress[user_id]["current_letter_index"] = 0
+
+    await send_letters_and_words(update, context, user_id)
+
+
+async def choose_dictionary_level(update: Update, context: CallbackContext):
+    await handle_my_dictionary_level(update, context)
+    context.user_data.pop("awaiting_dictionary_level", None)
+
+
+async def unexpected_input(update: Update, context: CallbackContext):
+    await update.message.reply_text("Пожалуйста, выбери номер варианта или нажми 'Выйти'.")
+
+
+MENU_STATES = ("menu", "what_letter", "dictionary_level")
+
+# (состояния, ввод, обработчик). Ввод None — обработчик по умолчанию для состояния.
+# Точный ввод сравнивается как есть, а затем в нижнем регистре, поэтому набираемые
+# вручную команды записаны строчными буквами.
+MESSAGE_ROUTES = [
+    (("spelling_check",), None, handle_spelling_input),  # Сама обрабатывает "выйти"
+
+    (("learn", "game", "letters") + MENU_STATES, "выйти", exit_to_menu),
+    (("learn",), None, check_word_translation),
+    (("game",), "Стоп 🛑", stop_game),
+    (("game",), None, check_game_translation),
+    (("letters",), None, check_user_response),
+
+    *((MENU_STATES, category, resetting(handle_choice)) for category in MENU_CATEGORIES),
+    (MENU_STATES, "Мой словарь", resetting(handle_my_dictionary)),
+    (MENU_STATES, "Учить новые слова", resetting(handle_learn_new_words)),
+    (MENU_STATES, "Что за буква?", resetting(handle_what_is_letter)),
+    (MENU_STATES, "Изучать буквы", start_letters),
+    (MENU_STATES, "Играть еще раз 🔄", handle_learn_from_dictionary),
+    (("what_letter",), None, handle_letter_input),
+
+    (("menu", "dictionary_level"), "играть", handle_learn_from_dictionary),
+    (("menu", "dictionary_level"), "очистить словарь", handle_clear_dictionary),
+    *((("menu",), level, handle_learn_new_words_level) for level in WORD_LEVELS),
+    *((("dictionary_level",), level, choose_dictionary_level) for level in WORD_LEVELS),
+    (("menu", "dictionary_level"), None, unexpected_input),
+]
+
+
+def compile_routes(routes):
+    """Собирает таблицу в словари: состояние -> ({ввод: обработчик}, обработчик по умолчанию)"""
+    compiled = {}
+    for states, text, handler in routes:
+        for state in states:
+            exact, default = compiled.get(state, ({}, None))
+            if text is None:
+                if default is not None:
+                    raise ValueError(f"Два обработчика по умолчанию для состояния {state}")
+                default = handler
+            elif text in exact:
+                raise ValueError(f"Повторный маршрут {state!r}, {text!r}")
+            else:
+                exact[text] = handler
+            compiled[state] = (exact, default)
+    return compiled
+
+
+ROUTER = compile_routes(MESSAGE_ROUTES)
+
+# Обработчики, которые завершают раздел: отложенные сообщения чата отменяются, а не досылаются
+INTERRUPTING_ROUTES = {exit_to_menu, stop_game}
+
+
+@instrumented
+async def handle_message(update: Update, context: CallbackContext):
+    user_input = update.message.text.strip()
+    exact, default = ROUTER[message_state(context.user_data)]
+    handler = exact.get(user_input) or exact.get(user_input.lower()) or default
+
+    # Отложенные сообщения не должны прийти после ответа на это сообщение
+    if handler in INTERRUPTING_ROUTES:
+        pacer.cancel(update.effective_chat.id)
+    else:
+        await pacer.hurry(update.effective_chat.id)
+
+    # Данные пользователя загружают только те обработчики, которым они нужны
+    try:
+        await handler(update, context)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        await update.message.reply_text(f"Произошла ошибка: {e}")
+
+# Сохранение состояния диалогов в Postgres
+
+PERSISTENCE_FLUSH_INTERVAL = 2  # Секунд между пакетными записями состояния
+
+
+def state_to_json(value):
+    # asyncpg.Record не является Mapping, поэтому проверяется отдельно
+    if isinstance(value, asyncpg.Record):
+        return dict(value.items())
+    if isinstance(value, Mapping):  # MappingProxyType и т. п.
+        return dict(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Несериализуемое значение: {type(value).__name__}")
+
+
+class PostgresPersistence(BasePersistence):
+    """Хранит context.user_data и user_progress в bot_user_state.
+
+    Записи копятся в памяти и пишутся одним executemany раз в
+    PERSISTENCE_FLUSH_INTERVAL секунд, неизменившиеся состояния пропускаются.
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=PERSISTENCE_FLUSH_INTERVAL
+        )
+        self.pending = {}   # user_id -> (user_data_json, progress_json)
+        self.written = {}   # user_id -> последнее записанное состояние
+        self.flush_task = None
+        self.flush_lock = None  # Создаётся в start(), в работающем цикле
+
+    async def get_user_data(self):
+        await db.ensure_user_state_schema()
+        user_data = {}
+        for row in await db.get_user_states():
+            user_id = row['user_id']
+            user_data[user_id] = json.loads(row['user_data'])
+            if row['progress']:
+                user_progress[user_id] = json.loads(row['progress'])
+            # Запоминаем загруженное состояние, чтобы не перезаписывать его без изменений
+            self.written[user_id] = self.serialize(user_id, user_data[user_id])
+        return user_data
+
+    @staticmethod
+    def serialize(user_id: int, data: dict):
+        progress = user_progress.get(user_id)
+        return (
+            json.dumps(data, default=state_to_json, ensure_ascii=False),
+            json.dumps(progress, default=state_to_json, ensure_ascii=False) if progress is not None else None
+        )
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # Только помечаем состояние как изменённое, запись будет пакетом
+        try:
+            state = self.serialize(user_id, data)
+        except (TypeError, ValueError) as e:
+            logging.error(f"Не удалось сохранить состояние {user_id}: {e}")
+            return
+        if self.written.get(user_id) != state:
+            self.pending[user_id] = state
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self.pending.pop(user_id, None)
+        self.written.pop(user_id, None)
+        await db.delete_user_state(user_id)
+
+    async def flush_pending(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            try:
+                await db.save_user_states([(user_id, *state) for user_id, state in batch.items()])
+                self.written.update(batch)
+            except BaseException as e:
+                # Возвращаем в очередь то, что не перезаписано более новым состоянием,
+                # в том числе при отмене задачи посреди записи
+                if not isinstance(e, asyncio.CancelledError):
+                    logging.error(f"Ошибка сохранения состояния: {e}")
+                for user_id, state in batch.items():
+                    self.pending.setdefault(user_id, state)
+                if not isinstance(e, Exception):
+                    raise
+
+    async def flush_forever(self):
+        while True:
+            await asyncio.sleep(PERSISTENCE_FLUSH_INTERVAL)
+            await self.flush_pending()
+
+    def start(self):
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = asyncio.create_task(self.flush_forever())
+
+    async def flush(self):
+        # Вызывается приложением при остановке; до start() обновления не обрабатывались
+        if not self.flush_task:
+            return
+        # Ждём отмены, чтобы прерванная пачка вернулась в очередь
+        self.flush_task.cancel()
+        await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush_pending()
+
+    # Остальные данные бот не использует
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+
+persistence = PostgresPersistence()
+
+
+# Параллельная обработка обновлений
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))  # Не больше размера пула БД
+MAX_PENDING_UPDATES = 4096  # Обновления, ожидающие своей очереди пользователя
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Разные пользователи обрабатываются параллельно, сообщения одного — строго по порядку.
+
+    Слот из MAX_CONCURRENT_UPDATES занимается только когда подошла очередь
+    пользователя, поэтому серия сообщений одного пользователя не держит слоты.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates=MAX_PENDING_UPDATES)
+        self.active = asyncio.Semaphore(max_concurrent_updates)
+        self.user_locks = {}   # user_id -> [asyncio.Lock, число ожидающих]
+
+    @staticmethod
+    def update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            async with self.active:
+                await coroutine
+            return
+
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.active:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.user_locks.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# Режим работы: polling или webhook
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # Публичный адрес; если не задан, set_webhook не вызывается
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Обязателен в режиме webhook
+
+
+def make_webhook_handler(app):
+    async def handle_webhook(request: web.Request):
+        # Telegram передаёт секрет в заголовке, сравниваем за постоянное время
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        # Некорректное тело — ошибка клиента, а не сервера
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, app.bot)
+        except (TypeError, ValueError, KeyError) as e:
+            logging.warning(f"Некорректное обновление webhook: {e}")
+            return web.Response(status=400)
+
+        # Сразу отдаём обновление приложению и отвечаем Telegram
+        await app.update_queue.put(update)
+        return web.Response()
+
+    return handle_webhook
+
+
+def check_webhook_config():
+    # Без секрета любой, кто знает адрес, может присылать боту поддельные обновления
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("Режим webhook требует WEBHOOK_SECRET")
+
+
+async def start_webhook_server(app):
+    server = web.Application(client_max_size=1024 * 1024)
+    server.router.add_post(WEBHOOK_PATH, make_webhook_handler(app))
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    logging.info(f"Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return runner
+
+
+def register_gauges(app):
+    # Значения считываются в момент опроса /metrics
+    pool_in_use = Gauge("korbot_db_pool_in_use", "Занятые соединения пула БД")
+    pool_in_use.set_function(lambda: db.pool.get_size() - db.pool.get_idle_size() if db.pool else 0)
+    pool_size = Gauge("korbot_db_pool_size", "Открытые соединения пула БД")
+    pool_size.set_function(lambda: db.pool.get_size() if db.pool else 0)
+
+    Gauge("korbot_update_queue_depth", "Обновления в очереди приложения").set_function(
+        lambda: app.update_queue.qsize()
+    )
+    Gauge("korbot_users_waiting", "Пользователи с необработанными обновлениями").set_function(
+        lambda: len(app.update_processor.user_locks) if isinstance(app.update_processor, PerUserUpdateProcessor) else 0
+    )
+    Gauge("korbot_broadcast_batch_active", "Пачка рассылки в работе у этого процесса").set_function(
+        lambda: 1 if broadcaster.current else 0
+    )
+    Gauge("korbot_paced_sequences", "Отложенные серии сообщений").set_function(
+        lambda: sum(len(series) for series in pacer.tails.values())
+    )
+    Gauge("korbot_progress_pending_users", "Пользователи с незаписанным прогрессом").set_function(
+        lambda: len(set(progress_buffer.score_deltas) | set(progress_buffer.progress) | set(progress_buffer.learned))
+    )
+    Gauge("korbot_state_pending_users", "Пользователи с незаписанным состоянием диалога").set_function(
+        lambda: len(persistence.pending)
+    )
+    Gauge("korbot_user_cache_size", "Строки пользователей в кэше").set_function(lambda: len(db.user_cache))
+
+
+def start_metrics_server(app):
+    if not METRICS_PORT:
+        return
+    try:
+        start_http_server(METRICS_PORT, addr=METRICS_HOST)
+    except OSError as e:
+        # Занятый порт не должен мешать боту принимать обновления
+        logging.error(f"Не удалось запустить метрики на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    register_gauges(app)
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+def build_application(token: str, base_url: str = None, with_updater: bool = True):
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .request(InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)  # Например, локальная заглушка Bot API
+    if not with_updater:
+        builder = builder.updater(None)  # Обновления приходят через собственный HTTP-сервер
+    app = builder.build()
+
+    # Регистрация обработчиков
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))  # Добавьте эту строку
+    app.add_handler(CallbackQueryHandler(handle_dictionary_page, pattern=r"^dict:"))
+    return app
+
+
+# Этапы запуска
+
+async def startup_phase(name: str, coroutine, required: bool = True):
+    """Выполняет этап запуска и пишет в лог его длительность"""
+    started = time.perf_counter()
+    try:
+        return await coroutine
+    except Exception as e:
+        if required:
+            raise
+        logging.error(f"Этап запуска «{name}» не выполнен: {e}")
+    finally:
+        logging.info(f"Запуск: {name} — {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+async def prepare_schema():
+    await db.ensure_learned_words_schema()
+    await db.ensure_review_schema()
+    await db.ensure_broadcast_schema()
+
+
 # Основная функция
 async def main():
+    started = time.perf_counter()
     try:
+        check_webhook_config()
+
         # Инициализация базы данных
-        await db.connect()
+        await startup_phase("подключение к БД", db.connect())
+
+        # Независимые этапы выполняются параллельно
+        await asyncio.gather(
+            startup_phase("схема БД", prepare_schema()),
+            startup_phase("кэш file_id", file_ids.load()),
+            startup_phase("кэш слов", catalog.load()),
+            startup_phase("локальная копия алфавита", alphabet.load_cached(), required=False),
+        )
 
         # Создание приложения
-        app = ApplicationBuilder().token(os.getenv("BOT_TOKEN")).build()
-
-        # Регистрация обработчиков
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))  # Добавьте эту строку
+        app = build_application(os.getenv("BOT_TOKEN"), with_updater=BOT_MODE != "webhook")
+        start_metrics_server(app)
 
         # Запуск бота
         await app.initialize()  # Инициализация приложения
         await app.start()       # Запуск приложения
-        await app.updater.start_polling()  # Запуск polling
+        persistence.start()
+        progress_buffer.start()
+        broadcaster.start(app.bot)
+        if BOT_MODE == "webhook":
+            webhook_runner = await start_webhook_server(app)
+        else:
+            await app.updater.start_polling()  # Запуск polling
+        logging.info(f"Бот принимает обновления через {(time.perf_counter() - started) * 1000:.0f} мс")
+
+        # Необязательные источники подгружаются уже после запуска
+        alphabet.start()
+        catalog.start()
 
         # Бесконечный цикл для поддержания работы бота
         await asyncio.Event().wait()
@@ -1284,14 +3067,26 @@ async def main():
         logging.error(f"Произошла ошибка: {e}")
     finally:
         # Корректное завершение работы
+        if 'webhook_runner' in locals():
+            await webhook_runner.cleanup()  # Остановка HTTP-сервера
         if 'app' in locals():
-            await app.updater.stop()  # Остановка polling
-            await app.stop()          # Остановка приложения
+            await broadcaster.stop()  # Прогресс сохраняется, пачку сразу может забрать другой процесс
+            if app.updater and app.updater.running:
+                await app.updater.stop()  # Остановка polling
+            await app.stop()          # Остановка приложения, обработчики завершены
+            await pacer.drain()  # Досылаем отложенные сообщения без пауз, пока бот доступен
+            await progress_buffer.stop()  # Записываем накопленный прогресс, новых изменений уже не будет
             await app.shutdown()     # Завершение работы приложения
+        await alphabet.stop()
+        await catalog.close()
         await db.close()  # Закрытие соединения с базой данных
 
 # Запуск программы
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
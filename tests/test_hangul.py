@@ -0,0 +1,61 @@
+import random
+import unicodedata
+
+import pytest
+
+import hangul
+
+
+def levenshtein(a, b):
+    # Обычная полная таблица — эталон для полосного варианта
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+@pytest.mark.parametrize("limit", [0, 1, 2, 3, 5])
+def test_bounded_distance_matches_levenshtein(limit):
+    rng = random.Random(limit)
+    for _ in range(2000):
+        a = "".join(rng.choice("abc") for _ in range(rng.randrange(9)))
+        b = "".join(rng.choice("abc") for _ in range(rng.randrange(9)))
+        assert hangul.bounded_distance(a, b, limit) == min(levenshtein(a, b), limit + 1), (a, b)
+
+
+def test_compound_final_is_split():
+    assert hangul.decompose("닭") == "ㄷㅏㄺ"
+    assert hangul.decompose("닭", split_compound=True) == "ㄷㅏㄹㄱ"
+    assert hangul.answer_key("닭") == "ㄷㅏㄹㄱ"
+
+
+def test_jamo_letters_are_unique_and_skip_spaces():
+    assert hangul.jamo_letters("닭") == ["ㄷ", "ㅏ", "ㄹ", "ㄱ"]
+    assert hangul.jamo_letters("안녕 안녕") == ["ㅇ", "ㅏ", "ㄴ", "ㅕ"]
+
+
+def test_conjoining_jamo_are_normalized():
+    # Отдельная чамо U+1100 приводится к U+3131, пара с гласной собирается в слог
+    assert hangul.decompose("\u1100") == "ㄱ"
+    assert hangul.decompose("\u1100\u1161") == "ㄱㅏ"
+
+
+def test_grade_exact_for_nfd_and_spaces():
+    key = hangul.answer_key("안녕하세요")
+    assert hangul.grade_answer(unicodedata.normalize("NFD", "안녕하세요"), key) == hangul.EXACT
+    assert hangul.grade_answer(" 안녕 하세요 ", key) == hangul.EXACT
+
+
+def test_grade_one_jamo_typo_is_near():
+    key = hangul.answer_key("사랑")  # ㅅㅏㄹㅏㅇ
+    assert hangul.grade_answer("사란", key) == hangul.NEAR
+    assert hangul.grade_answer("사", key) == hangul.WRONG
+    assert hangul.grade_answer("", key) == hangul.WRONG
+
+
+def test_grade_short_word_needs_exact_answer():
+    # В слове из трёх букв ошибок не допускается
+    assert hangul.grade_answer("밀", hangul.answer_key("물")) == hangul.WRONG
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+kor_bot = pytest.importorskip("kor_bot")
+asyncpg = pytest.importorskip("asyncpg")
+
+
+def lesson_user_data(word_row):
+    # Состояние пользователя посреди урока, игры и проверки написания
+    return {
+        "mode": "learn",
+        "current_level": 2,
+        "current_word": "사랑해요",
+        "current_word_index": 4,
+        "current_word_id": 10,
+        "session_total": 120,
+        "correct_translation": "любовь",
+        "current_options": ["любовь", "дом", "вода"],
+        "game_words": [10, 11],
+        "current_game_index": 1,
+        "spelling_check": {"word_id": 10, "word": "사랑", "ease": 2.5, "interval_days": 0.0, "repetitions": 0},
+        # До перехода на id урок хранил сами строки слов: состояние из старых версий тоже должно сохраняться
+        "current_words": [word_row] if word_row is not None else [11, 12, 13],
+    }
+
+
+async def fetch_word_row():
+    conn = await asyncpg.connect(os.environ["DB_URL"])
+    try:
+        return await conn.fetchrow(
+            "SELECT 10 AS id, '사랑' AS word, 'любовь' AS translation, 2 AS level, "
+            "ARRAY['사랑해요'] AS examples, now() AS learned_at"
+        )
+    finally:
+        await conn.close()
+
+
+@pytest.mark.skipif(not os.getenv("DB_URL"), reason="нужен DB_URL для настоящей asyncpg.Record")
+def test_serialize_lesson_state_with_record():
+    row = asyncio.run(fetch_word_row())
+    assert isinstance(row, asyncpg.Record)
+
+    user_data, progress = kor_bot.PostgresPersistence.serialize(1, lesson_user_data(row))
+    restored = json.loads(user_data)
+
+    assert restored["current_words"][0]["word"] == "사랑"
+    assert restored["current_words"][0]["examples"] == ["사랑해요"]
+    assert restored["current_word"] == "사랑해요"
+    assert restored["spelling_check"]["word"] == "사랑"
+
+
+def test_serialize_lesson_state_with_ids():
+    user_data, progress = kor_bot.PostgresPersistence.serialize(1, lesson_user_data(None))
+    restored = json.loads(user_data)
+    assert restored["current_words"] == [11, 12, 13]
+    assert restored["current_options"] == ["любовь", "дом", "вода"]
@@ -0,0 +1,119 @@
+"""Прогон записанных обновлений через webhook бота без Telegram.
+
+Пример:
+    BOT_MODE=webhook WEBHOOK_SECRET=test python kor_bot.py
+    python webhook_replay.py updates.jsonl --secret test --concurrency 50 --repeat 10
+
+Файл содержит по одному JSON-обновлению Telegram в строке. Без файла
+можно сгенерировать текстовые сообщения: --synthetic 1000 --users 100.
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import statistics
+import time
+
+from aiohttp import ClientSession, ClientTimeout
+
+
+def load_updates(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_updates(count: int, users: int, text: str):
+    updates = []
+    for i in range(count):
+        user_id = 100000 + i % users
+        updates.append({
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text,
+            },
+        })
+    return updates
+
+
+def percentile(values, q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(url: str, updates, secret: str, concurrency: int, repeat: int):
+    update_ids = itertools.count(1)
+    queue = asyncio.Queue()
+    for _ in range(repeat):
+        for update in updates:
+            # Уникальный update_id, как у настоящих обновлений
+            update = copy.deepcopy(update)
+            update["update_id"] = next(update_ids)
+            queue.put_nowait(update)
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+    errors = 0
+
+    async def worker(session: ClientSession):
+        nonlocal errors
+        while True:
+            try:
+                update = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    total = queue.qsize()
+    started = time.perf_counter()
+    async with ClientSession(timeout=ClientTimeout(total=30)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    print(f"Обновлений: {total}, ошибок: {errors}, время: {elapsed:.2f} с")
+    print(f"Пропускная способность: {total / elapsed:.1f} обновлений/с")
+    if latencies:
+        print(
+            f"Задержка, мс: p50={percentile(latencies, 0.5) * 1000:.1f} "
+            f"p95={percentile(latencies, 0.95) * 1000:.1f} "
+            f"p99={percentile(latencies, 0.99) * 1000:.1f} "
+            f"mean={statistics.mean(latencies) * 1000:.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон webhook бота")
+    parser.add_argument("updates", nargs="?", help="JSONL-файл с записанными обновлениями")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--synthetic", type=int, default=0, help="Сгенерировать N сообщений")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--text", default="Учить новые слова")
+    args = parser.parse_args()
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    elif args.synthetic:
+        updates = synthetic_updates(args.synthetic, args.users, args.text)
+    else:
+        parser.error("Укажите файл с обновлениями или --synthetic N")
+
+    asyncio.run(replay(args.url, updates, args.secret, args.concurrency, args.repeat))
+
+
+if __name__ == "__main__":
+    main()